@@ -45,6 +45,10 @@ def IsClasses(entityFacts):
 
 class treatWikidataEntity():
     """ Visitor that will handle every Wikidata entity """
+    # The only triples visit() looks at; NtUtils skips all other lines of the dump
+    predicates={Prefixes.rdfsLabel, Prefixes.wikidataType, Prefixes.wikidataOccupation, Prefixes.wikidataSubClassOf}
+    languages={"en"}
+
     def __init__(self,i):
         """ We load everything once per process (!) in order to avoid problems with shared memory """
         print("    Initializing Wikidata reader",i+1, flush=True)
@@ -80,13 +84,13 @@ class treatWikidataEntity():
 
 if __name__ == "__main__":
 
-    WIKIDATA_FILE = os.path.join("../data/wikidata", "latest-truthy.nt")
+    WIKIDATA_FILE = NtUtils.wikidataFile(os.path.join("../data/wikidata", "latest-truthy.nt"))
     FOLDER="../data/wikidata/"
 
     # check if the wikidata dump exists
-    if not os.path.exists(WIKIDATA_FILE):
+    if not WIKIDATA_FILE:
         raise FileNotFoundError("Please first download the latest Wikidata dump \
-                                from https://dumps.wikimedia.org/wikidatawiki/entities/ and place it in the folder 'data/wikidata/' and also decompress it.")
+                                from https://dumps.wikimedia.org/wikidatawiki/entities/ and place it in the folder 'data/wikidata/' (latest-truthy.nt, or compressed as .bz2, .gz or .zst).")
 
     VALID_METACLS = set(pd.read_csv(os.path.join(FOLDER, 'metaclasses.csv'))['qid'].tolist())
     TOPCLS = set(pd.read_csv(os.path.join(FOLDER, 'topcls.csv'))['qid'].tolist()) # top level classes (children of 'entity' class)
@@ -10,10 +10,22 @@ import os
 import codecs
 import re
 import sys
+import time
 from io import StringIO
+from itertools import zip_longest
 import Prefixes
 # import TsvUtils
-from multiprocessing import Pool
+from multiprocessing import Process, Queue
+from collections import defaultdict
+import traceback
+import tracemalloc
+import mmap
+from array import array
+import numpy as np
+import zlib
+import bz2
+import struct
+import bisect
 
 TEST=False
 
@@ -25,6 +37,10 @@ def printError(*args, **kwargs):
     """ Prints an error to StdErr """
     print(*args, file=sys.stderr, **kwargs)
 
+def cleanLiteral(literal):
+    """ Makes a literal a simple literal without line breaks and quotes """
+    return literal.replace('\n','\\n').replace('\t','\\t').replace('\r','').replace('\\"',"'").replace("\\u0022","'").encode().decode('unicode_escape')
+
 def termsAndSeparators(generator):
     """ Iterator over the terms of char reader """
     pushBack=None
@@ -93,7 +109,7 @@ def termsAndSeparators(generator):
                     char=None
                     literal="".join(literal)
             # Make all literals simple literals without line breaks and quotes
-            literal=literal.replace('\n','\\n').replace('\t','\\t').replace('\r','').replace('\\"',"'").replace("\\u0022","'").encode().decode('unicode_escape')
+            literal=cleanLiteral(literal)
             if not char:
                 char=next(generator, None)
             if char=='^':
@@ -110,10 +126,7 @@ def termsAndSeparators(generator):
                         break
                     datatype=datatype+char
                     if datatype.startswith('<') and datatype.endswith('>'):
-                        for prefix, uri in Prefixes.prefixes.items():
-                            if uri in datatype:
-                                datatype = datatype.replace(uri, f"{prefix}:").replace("<", "").replace(">", "")
-                                break
+                        datatype=Prefixes.compact(datatype)
                         break
                 if not datatype or len(datatype)<3:
                     printError("Invalid literal datatype:", datatype)
@@ -147,11 +160,7 @@ def termsAndSeparators(generator):
                     break
             term_with_prefix+='>'
             term = "".join(term_with_prefix) # replace the prefix with sth.
-            for prefix, uri in Prefixes.prefixes.items():
-                if uri in term:
-                    term = term.replace(uri, f"{prefix}:").replace("<", "").replace(">", "")
-                    break
-            yield term
+            yield Prefixes.compact(term)
         elif char in ['.',',',';','[',']','(',')']:
             # Separators
             yield char
@@ -168,8 +177,17 @@ def termsAndSeparators(generator):
             yield "".join(iri)
 
 
-def triplesFromTerms(generator, predicates=None, givenSubject=None):
-    """ Iterator over the triples of a term generator """
+def hasLanguage(term, languages):
+    """ TRUE if the term is not a language-tagged literal, or has one of the languages """
+    if not term.startswith('"'):
+        return True
+    literal, at, language = term.rpartition('"@')
+    return not at or language in languages
+
+def triplesFromTerms(generator, predicates=None, givenSubject=None, languages=None):
+    """ Iterator over the triples of a term generator.
+    If predicates are given, yields only triples with these predicates.
+    If languages are given, yields only triples whose language-tagged literals have one of these languages """
     while True:        
         term=next(generator, None)
         if not term or term==']':
@@ -196,14 +214,129 @@ def triplesFromTerms(generator, predicates=None, givenSubject=None):
             printError("Unexpected",object,"after",subject,predicate)
             return
         else:
-            if (not predicates) or (predicate in predicates):
+            if ((not predicates) or (predicate in predicates)) and ((not languages) or hasLanguage(object, languages)):
                 yield (subject, predicate, object)
 
 
+##########################################################################
+#             Parsing N-Triples
+##########################################################################
+
+# N-Triples has one triple per line, so that we can parse a whole line
+# with one regex instead of going character by character.
+# Lines that do not match fall back to termsAndSeparators.
+ntResourceRegex='<[^>]*>|_:[^\\s.,;\\[\\]"\'^@()]+'
+ntTripleRegex=re.compile('[ \\t]*('+ntResourceRegex+')[ \\t]*(<[^>]*>)[ \\t]*'
+                         '(?:('+ntResourceRegex+')|"((?:[^"\\\\]|\\\\.)*)"(?:\\^\\^(<[^>]*>)|@([-A-Za-z0-9]+))?)'
+                         '[ \\t]*\\.[ \\t\\r]*(?:#.*)?')
+
+def termFromNt(term):
+    """ Returns the term as termsAndSeparators would produce it """
+    return Prefixes.compact(term) if term[0]=='<' else term
+
+def tripleFromNtLine(line):
+    """ Returns the (subject, predicate, object) of an N-Triples line, or None if the line is not a plain triple """
+    match=ntTripleRegex.fullmatch(line)
+    if not match:
+        return None
+    subject, predicate, resource, literal, datatype, language = match.groups()
+    if resource:
+        object=termFromNt(resource)
+    elif datatype:
+        object='"'+cleanLiteral(literal)+'"^^'+Prefixes.compact(datatype)
+    elif language:
+        if len(language)>20 or len(language)<2:
+            printError("Invalid literal language:", language)
+        object='"'+cleanLiteral(literal)+'"@'+language
+    else:
+        object='"'+cleanLiteral(literal)+'"'
+    return (termFromNt(subject), Prefixes.compact(predicate), object)
+
+# Regex for the language tag at the end of an N-Triples line
+ntLanguageRegex=re.compile(rb'"@([-A-Za-z0-9]+)[ \t]*\.[ \t\r]*$')
+
+def ntLineFilter(predicates=None, languages=None):
+    """ Returns a function that tells from the bytes of an N-Triples line whether the line
+    can contain one of the predicates and, if it ends in a language-tagged literal, one of the languages.
+    This test is cheap but not exact: triples of accepted lines still have to be checked """
+    patterns=[Prefixes.expand(predicate).encode() for predicate in predicates] if predicates else None
+    tags={language.encode() for language in languages} if languages else None
+    def accept(line):
+        if patterns and not any(pattern in line for pattern in patterns):
+            return False
+        if tags:
+            match=ntLanguageRegex.search(line)
+            if match and match.group(1) not in tags:
+                return False
+        return True
+    return accept
+
+def triplesFromNtLines(lines, predicates=None, languages=None):
+    """ Iterator over the triples of an iterator over N-Triples lines (as bytes).
+    Predicates and languages filter the triples as in triplesFromTerms,
+    but lines that cannot match are skipped before they are parsed """
+    accept=ntLineFilter(predicates, languages) if predicates or languages else None
+    for line in lines:
+        if accept and not accept(line):
+            continue
+        line=line.decode("utf-8")
+        triple=tripleFromNtLine(line)
+        if triple:
+            if ((not predicates) or (triple[1] in predicates)) and ((not languages) or hasLanguage(triple[2], languages)):
+                yield triple
+            continue
+        # Comments, empty lines, and everything that is not plain N-Triples
+        stripped=line.strip()
+        if not stripped or stripped.startswith('#'):
+            continue
+        yield from triplesFromTerms(termsAndSeparators(iter(line)), predicates, languages=languages)
+
 ##########################################################################
 #             Reading files
 ##########################################################################
 
+# Buffer sizes  
+kilo=1024
+mega=1024*kilo
+giga=1024*mega
+
+BLOCK=8*mega
+
+# Size of the chunks that the Wikidata readers take from the work queue
+CHUNK=64*mega
+
+# Compressed bytes after which a Wikidata reader reports its progress within a chunk
+PROGRESS_STEP=16*mega
+
+# Suffix of the line that starts a Wikidata item
+itemSuffix=b"<http://wikiba.se/ontology#Item> ."
+
+class NtLineReader(object):
+    """ Iterator over the lines (as bytes, without line breaks) of a binary reader, up to the byte offset <end>.
+    Reads large blocks at a time, and keeps in <position> the byte offset after the last line """
+    def __init__(self, reader, blockSize=BLOCK, end=None):
+        self.reader=reader
+        self.blockSize=blockSize
+        self.position=reader.tell()
+        self.end=end
+    def __iter__(self):
+        rest=b""
+        readPosition=self.position
+        while True:
+            size=self.blockSize if self.end is None else min(self.blockSize, self.end-readPosition)
+            block=self.reader.read(size) if size>0 else b""
+            readPosition+=len(block)
+            if not block:
+                break
+            lines=(rest+block).split(b"\n")
+            rest=lines.pop()
+            for line in lines:
+                self.position+=len(line)+1
+                yield line
+        if rest:
+            self.position+=len(rest)
+            yield rest
+
 def byteGenerator(byteReader):
     """ Generates bytes from the reader """
     while True:
@@ -217,15 +350,219 @@ def charGenerator(byteGenerator):
     """ Generates chars from bytes """
     return codecs.iterdecode(byteGenerator, "utf-8")
 
-def triplesFromNtFile(file, message=None, predicates=None):
-    """ Iterator over the triples in a NT file """
+def triplesFromNtFile(file, message=None, predicates=None, languages=None):
+    """ Iterator over the triples in a NT file (which may be compressed) """
+    if message:
+        print(message+"... ",end="",flush=True)
+    with openNtFile(file) as reader:
+        yield from triplesFromNtLines(NtLineReader(reader), predicates, languages)
+    if message:
+        print("done", flush=True)
+
+def triplesFromTurtleFile(file, message=None, predicates=None, languages=None):
+    """ Iterator over the triples in a Turtle file (or an NT file, character by character) """
     if message:
         print(message+"... ",end="",flush=True)
     with open(file,"rb") as reader:
-        yield from triplesFromTerms(termsAndSeparators(charGenerator(byteGenerator(reader))), predicates)
+        yield from triplesFromTerms(termsAndSeparators(charGenerator(byteGenerator(reader))), predicates, languages=languages)
     if message:
         print("done", flush=True)
     
+##########################################################################
+#             Reading compressed files
+##########################################################################
+
+# Reading .zst files needs the package zstandard
+try:
+    import zstandard
+except ImportError:
+    zstandard=None
+
+def compression(file):
+    """ Returns the compression of a file ('gz', 'bz2', 'zst'), or None if it is not compressed """
+    for kind in ("gz", "bz2", "zst"):
+        if file.endswith("."+kind):
+            return kind
+    return None
+
+def newDecompressor(kind):
+    """ Returns a decompressor for one member (gzip member, bz2 stream, zstd frame) """
+    if kind=="gz":
+        return zlib.decompressobj(31)
+    if kind=="bz2":
+        return bz2.BZ2Decompressor()
+    if not zstandard:
+        raise ImportError("Reading .zst files needs the package zstandard")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+class DecompressingReader(object):
+    """ Binary reader over the decompressed content of a compressed file, starting at the member
+    that begins at the compressed byte offset <start>, and continuing over all following members.
+    <compressedPosition> is the compressed offset up to which the input has been decompressed.
+    If a member ends exactly at the compressed offset <end>, <endPosition> becomes the
+    decompressed offset (counted from <start>) at which that happens """
+    def __init__(self, file, start=0, end=None, blockSize=mega):
+        self.kind=compression(file)
+        self.raw=open(file, "rb")
+        self.raw.seek(start)
+        self.compressedPosition=start
+        # The seek table of a seekable zstd file is not part of the data
+        self.dataEnd=zstdFrames(file)[1] if self.kind=="zst" else None
+        self.end=end
+        self.endPosition=None
+        self.blockSize=blockSize
+        self.decompressor=newDecompressor(self.kind)
+        self.buffer=bytearray()
+        self.position=0
+        self.rest=b""
+    def fill(self):
+        """ Decompresses the next block of input into the buffer; returns False at the end of the input """
+        data=self.rest
+        if not data:
+            size=self.blockSize if self.dataEnd is None else min(self.blockSize, self.dataEnd-self.raw.tell())
+            data=self.raw.read(size) if size>0 else b""
+        self.rest=b""
+        if not data:
+            return False
+        position=self.compressedPosition
+        output=self.decompressor.decompress(data)
+        self.buffer+=output
+        self.position+=len(output)
+        if self.decompressor.eof:
+            unused=self.decompressor.unused_data
+            position+=len(data)-len(unused)
+            if position==self.end:
+                self.endPosition=self.position
+            self.decompressor=newDecompressor(self.kind)
+            # Some files are padded with zeros after the last member
+            self.rest=unused if unused.strip(b"\0") else b""
+        else:
+            position+=len(data)
+        self.compressedPosition=position
+        return True
+    def read(self, size=-1):
+        while size<0 or len(self.buffer)<size:
+            if not self.fill():
+                break
+        if size<0:
+            size=len(self.buffer)
+        result=bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return result
+    def tell(self):
+        return self.position-len(self.buffer)
+    def close(self):
+        self.raw.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, *exceptions):
+        self.close()
+
+def openNtFile(file):
+    """ Returns a binary reader over the (decompressed) content of the file """
+    return DecompressingReader(file) if compression(file) else open(file, "rb")
+
+# Magic numbers of the start of a member:
+# bz2 stream header followed by the magic number of its first block, and gzip member header
+bz2MemberRegex=re.compile(rb"BZh[1-9]1AY&SY")
+gzMemberRegex=re.compile(rb"\x1f\x8b\x08")
+
+def isMemberStart(reader, kind, position):
+    """ TRUE if a member can be decompressed from the compressed offset position """
+    reader.seek(position)
+    try:
+        newDecompressor(kind).decompress(reader.read(64*kilo))
+        return True
+    except Exception:
+        return False
+
+def nextMemberStart(reader, kind, position, fileSize):
+    """ Returns the compressed offset of the first member that starts at or after position (or the end of the file) """
+    if position==0:
+        return 0
+    regex=bz2MemberRegex if kind=="bz2" else gzMemberRegex
+    while position<fileSize:
+        reader.seek(position)
+        # Overlap the blocks so that we do not miss a magic number at the border
+        block=reader.read(mega+16)
+        for match in regex.finditer(block):
+            if match.start()<mega and isMemberStart(reader, kind, position+match.start()):
+                return position+match.start()
+        position+=mega
+    return fileSize
+
+def memberStarts(reader, kind, positions, fileSize):
+    """ Returns the offsets of the first members that start at or after the increasing positions (or the end of the file).
+    The file is scanned once, front to back: a position below a member start found before reuses it,
+    and the scan stops once it has reached the end of the file (a file with a single member is read once) """
+    starts=[]
+    found=0
+    for position in positions:
+        if found<position and found<fileSize:
+            found=nextMemberStart(reader, kind, position, fileSize)
+        starts.append(found)
+    return starts
+
+def zstdFrames(file):
+    """ Returns the compressed offsets of the frames of a seekable zstd file (or None if it has no seek table),
+    and the offset at which the frames end """
+    fileSize=os.path.getsize(file)
+    with open(file, "rb") as reader:
+        if fileSize<9:
+            return (None, fileSize)
+        reader.seek(fileSize-9)
+        numFrames, descriptor, magic = struct.unpack("<IBI", reader.read(9))
+        if magic!=0x8F92EAB1:
+            return (None, fileSize)
+        # Each entry has the compressed size, the decompressed size, and possibly a checksum
+        entrySize=12 if descriptor & 0x80 else 8
+        reader.seek(fileSize-9-numFrames*entrySize)
+        table=reader.read(numFrames*entrySize)
+    starts=[0]
+    for i in range(numFrames):
+        starts.append(starts[-1]+struct.unpack_from("<I", table, i*entrySize)[0])
+    return (starts[:-1], starts[-1])
+
+def compressedChunks(file, chunkSize=CHUNK):
+    """ Returns the chunk index of a compressed file: a list of (start, end) compressed byte offsets
+    of roughly chunkSize bytes that start with a member that can be decompressed independently.
+    A file that consists of a single member has a single chunk """
+    kind=compression(file)
+    fileSize=os.path.getsize(file)
+    if kind=="zst":
+        frames, dataEnd = zstdFrames(file)
+        if not frames:
+            return [(0, fileSize)]
+        starts=sorted({frames[min(bisect.bisect_left(frames, position), len(frames)-1)] for position in range(0, dataEnd, chunkSize)})
+        return list(zip(starts, starts[1:]+[dataEnd]))
+    with open(file, "rb") as reader:
+        starts=sorted(set(memberStarts(reader, kind, range(0, fileSize, chunkSize), fileSize)))
+    return [(start, end) for start, end in zip(starts, starts[1:]+[fileSize]) if start<end]
+
+def pastEnd(lines, reader, line):
+    """ TRUE if the line just read by the NtLineReader starts after the end of the chunk of the DecompressingReader """
+    return reader.endPosition is not None and reader.endPosition<lines.position-len(line)-1
+
+def linesOfCompressedChunk(lines, reader, isFirst):
+    """ Yields the lines of an NtLineReader on a DecompressingReader that belong to the chunk:
+    A chunk starts at the first item line that starts after its first byte (or at the start of the file),
+    and ends before the first item line that starts after the end of the chunk """
+    iterator=iter(lines)
+    if not isFirst:
+        # The first line started in the previous chunk
+        next(iterator, None)
+        for line in iterator:
+            if line.rstrip().endswith(itemSuffix):
+                # A chunk without an item line start (within an entity larger than the chunk) has no line
+                if pastEnd(lines, reader, line):
+                    return
+                yield line
+                break
+    for line in iterator:
+        if line.rstrip().endswith(itemSuffix) and pastEnd(lines, reader, line):
+            return
+        yield line
+
 ##########################################################################
 #             Graphs
 ##########################################################################
@@ -359,6 +696,104 @@ class Graph(object):
     def __len__(self):
         return len(self.index)
 
+class EntityFacts(object):
+    """ The triples about a single subject, with the query API of Graph.
+    Used for the entities of Wikidata, where a Graph (with its inverse graph,
+    nested dicts and sets) would be much bigger and slower than needed """
+    __slots__=("subject", "index", "predicateSet", "inverse")
+    def __init__(self):
+        self.subject=None
+        # predicate -> list of objects (without duplicates)
+        self.index={}
+        # Built when needed, and dropped when the triples change
+        self.predicateSet=None
+        self.inverse=None
+    def add(self, triple):
+        (subject, predicate, obj) = triple
+        if self.subject is None:
+            self.subject=subject
+        elif subject!=self.subject:
+            raise Exception("EntityFacts of "+self.subject+" cannot contain triples about "+subject)
+        objects=self.index.get(predicate)
+        if objects is None:
+            self.index[predicate]=[obj]
+            self.predicateSet=None
+        elif obj in objects:
+            return
+        else:
+            objects.append(obj)
+        self.inverse=None
+    def remove(self, triple):
+        (subject, predicate, obj) = triple
+        if subject!=self.subject or predicate not in self.index:
+            return
+        objects=self.index[predicate]
+        if obj not in objects:
+            return
+        objects.remove(obj)
+        if not objects:
+            self.index.pop(predicate)
+            self.predicateSet=None
+            if not self.index:
+                self.subject=None
+        self.inverse=None
+    def __contains__(self, triple):
+        (subject, predicate, obj) = triple
+        return subject==self.subject and obj in self.index.get(predicate, ())
+    def __iter__(self):
+        for p, objects in self.index.items():
+            for o in objects:
+                yield (self.subject, p, o)
+    def predicates(self):
+        # The set is not changed afterwards, so that callers can remove triples while they iterate over it
+        if self.predicateSet is None:
+            self.predicateSet=frozenset(self.index)
+        return self.predicateSet
+    def objects(self, subject=None, predicate=None):
+        # As in Graph, we create a copy
+        if subject and subject!=self.subject:
+            return []
+        if predicate:
+            return list(self.index.get(predicate, ()))
+        return [o for objects in self.index.values() for o in objects]
+    def subjects(self, predicate=None, object=None):
+        # As in Graph, the subject appears once per matching triple
+        if object is None:
+            count=len(self.index.get(predicate, ())) if predicate else sum(len(objects) for objects in self.index.values())
+        else:
+            if self.inverse is None:
+                self.inverse={}
+                for p, objects in self.index.items():
+                    for o in objects:
+                        self.inverse.setdefault(o, []).append(p)
+            predicates=self.inverse.get(object, ())
+            count=predicates.count(predicate) if predicate else len(predicates)
+        return [self.subject]*count
+    def triplesWithPredicate(self, *predicates):
+        result=[]
+        for predicate in predicates:
+            for object in self.index.get(predicate, ()):
+                result.append((self.subject, predicate, object))
+        return result
+    def printToWriter(self, result):
+        if self.subject is None:
+            return
+        result.write("\n")
+        result.write(self.subject)
+        result.write(' ')
+        result.write(' ;\n\t'.join(p+' '+', '.join(objects) for p, objects in self.index.items()))
+        result.write(' .\n')
+    def __str__(self):
+        buffer=StringIO()
+        buffer.write("# RDF Graph\n")
+        self.printToWriter(buffer)
+        return buffer.getvalue()
+    def someSubject(self):
+        return self.subject
+    def __len__(self):
+        # Number of subjects, as in Graph
+        return 0 if self.subject is None else 1
+
 # Regex for literals
 literalRegex=re.compile('"([^"]*)"(@([a-z-]+))?(\\^\\^(.*))?')
 
@@ -415,9 +850,9 @@ def about(triple):
     #     return "wd:Q"+s[3:s.index('-')] # e.g. s:Q23-75a7caca-405a -> wd:Q23
     return None
 
-def entitiesFromTriples(tripleIterator):
-    """ Yields graphs about entities from the triples """
-    graph=Graph()
+def entitiesFromTriples(tripleIterator, factory=EntityFacts):
+    """ Yields graphs about entities from the triples (by default as EntityFacts) """
+    graph=factory()
     currentSubject="Elvis"
     for triple in tripleIterator:
         newSubject=about(triple)
@@ -426,54 +861,277 @@ def entitiesFromTriples(tripleIterator):
         if newSubject!=currentSubject:
             if len(graph):
                 yield graph
-                graph=Graph()
+                graph=factory()
             currentSubject=newSubject
         graph.add(triple)
     if len(graph):
         yield graph
 
-# Buffer sizes  
-kilo=1024
-mega=1024*kilo
-giga=1024*mega
+def nextItemStart(reader, position):
+    """ Returns the offset of the first Wikidata item line that starts at or after position (or the end of the file) """
+    if position==0:
+        return 0
+    # Finish the line in which position-1 lies, so that we are at the start of a line
+    reader.seek(position-1)
+    reader.readline()
+    while True:
+        start=reader.tell()
+        line=reader.readline()
+        if not line or line.rstrip().endswith(itemSuffix):
+            return start
 
-def visitWikidataEntities(args):
-    """ Visits the Wikidata entities. The arguments are
-              file, visitor, portion, size
-    The visitor is called on all Wikidata entities in the file,
-    starting from portion*size """
-    # The arguments are packed in a single argument
-    # so that we can call Pool.map() with this function.
-    # So we unpack them.
-    file, visitor, portion, size = args
-    print("    Starting Wikidata reader",portion+1)
-    with open(file,"rb", buffering=1*mega) as wikidataReader:
-        wikidataReader.seek(portion*size)
-        # Seek to next Wikidata item
-        line=b"NONE"
-        for line in wikidataReader:
-            if line.rstrip().endswith(b"<http://wikiba.se/ontology#Item> ."):
-                break
-        print("    Running Wikidata reader",portion+1,"at",wikidataReader.tell(),"with \"",line.rstrip().decode("utf-8"),'"', flush=True)        
-        for graph in entitiesFromTriples(triplesFromTerms(termsAndSeparators(charGenerator(byteGenerator(wikidataReader))))):
+def wikidataChunks(file, chunkSize=CHUNK):
+    """ Returns the chunk index of a Wikidata file: a list of (start, end) byte offsets
+    of roughly chunkSize bytes that start with a Wikidata item line (except the first) """
+    fileSize=os.path.getsize(file)
+    with open(file,"rb") as reader:
+        starts=sorted({nextItemStart(reader, position) for position in range(0, fileSize, chunkSize)})
+    return [(start, end) for start, end in zip(starts, starts[1:]+[fileSize]) if start<end]
+
+def visitWikidataChunk(file, visitor, start, end, progress=None):
+    """ Calls the visitor on all Wikidata entities between the byte offsets start and end
+    (compressed offsets for compressed files), and returns the number of entities.
+    If the visitor has the attributes <predicates> and <languages>, only these triples are parsed.
+    For compressed files, progress(bytes) is called with the compressed bytes consumed since the last call,
+    every PROGRESS_STEP bytes, so that a chunk of a single-member file shows progress as well """
+    predicates=getattr(visitor, "predicates", None)
+    languages=getattr(visitor, "languages", None)
+    count=0
+    if compression(file):
+        wikidataReader=DecompressingReader(file, start, end)
+        lines=NtLineReader(wikidataReader)
+        lines=linesOfCompressedChunk(lines, wikidataReader, start==0)
+    else:
+        wikidataReader=open(file,"rb")
+        wikidataReader.seek(start)
+        lines=NtLineReader(wikidataReader, end=end)
+    reported=start
+    with wikidataReader:
+        for graph in entitiesFromTriples(triplesFromNtLines(lines, predicates, languages)):
             visitor.visit(graph) # one subject(entity) -> one subgraph
-            if wikidataReader.tell()>portion*size+size:
-                break            
-    print("    Finished Wikidata reader",portion+1, flush=True)        
-    return visitor.result()
+            count+=1
+            if progress and compression(file) and wikidataReader.compressedPosition-reported>=PROGRESS_STEP:
+                consumed=min(wikidataReader.compressedPosition, end)
+                progress(consumed-reported)
+                reported=consumed
+    return count
+
+def visitWikidataEntities(number, file, visitor, chunks, results):
+    """ Wikidata reader <number>: creates the visitor, calls it on the chunks that it takes
+    from the queue <chunks> until it gets None, and puts into the queue <results>
+    the timing (chunk, start, end, entities, seconds, reader) of each chunk, and finally its result """
+    try:
+        print("    Starting Wikidata reader",number+1, flush=True)
+        visitor=visitor(number)
+        while True:
+            chunk=chunks.get()
+            if chunk is None:
+                break
+            index, start, end = chunk
+            startTime=time.perf_counter()
+            count=visitWikidataChunk(file, visitor, start, end, lambda size: results.put(("progress", number, (index, size))))
+            results.put(("chunk", number, (index, start, end, count, time.perf_counter()-startTime, number)))
+        print("    Finished Wikidata reader",number+1, flush=True)
+        results.put(("result", number, visitor.result()))
+    except Exception:
+        results.put(("error", number, traceback.format_exc()))
 
-def visitWikidata(file, visitor, numThreads=95):
-    """ Runs numThreads parallel threads that each visit a portion of Wikidata with the visitor """
+def printChunkTimings(timings):
+    """ Prints statistics about the time the Wikidata readers spent on the chunks """
+    timings=sorted(timings, key=lambda timing: timing[4], reverse=True)
+    seconds=[timing[4] for timing in timings]
+    busy=defaultdict(float)
+    for timing in timings:
+        busy[timing[5]]+=timing[4]
+    print(f"  Info: {len(timings)} chunks, {sum(timing[3] for timing in timings)} entities, {sum(seconds):.0f}s in total")
+    print(f"  Info: Seconds per chunk: min {seconds[-1]:.2f}, mean {sum(seconds)/len(seconds):.2f}, max {seconds[0]:.2f}")
+    print(f"  Info: Busy seconds per reader: min {min(busy.values()):.0f}, max {max(busy.values()):.0f}")
+    for index, start, end, count, duration, number in timings[:5]:
+        print(f"    Slowest chunk {index} (bytes {start}-{end}, {count} entities): {duration:.2f}s by reader {number+1}")
+
+def wikidataFile(file):
+    """ Returns the file if it exists, or else the first existing compressed version of it (.bz2, .gz, .zst), or None """
+    for candidate in (file, file+".bz2", file+".gz", file+".zst"):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def visitWikidata(file, visitor, numThreads=None, chunkSize=CHUNK):
+    """ Runs numThreads (default: number of CPUs) parallel readers that each create one visitor
+    and call it on chunks of Wikidata, taken from a common queue as they go. Returns the results of the visitors.
+    The chunks come from the index of the file if there is one (see indexWikidata).
+    Compressed files (.gz, .bz2, .zst) are read directly, in chunks of members where the file has several """
+    numThreads=numThreads or os.cpu_count()
     fileSize=os.path.getsize(file)
-    if numThreads>fileSize/10000000:
-        numThreads=int(fileSize/10000000)+1
-    print("  Running",numThreads,"Wikidata readers", flush=True)
-    portionSize=int(fileSize/numThreads)
-    with Pool(processes=numThreads) as pool:
-        result=pool.map(visitWikidataEntities, ((file, visitor(i), i, portionSize,) for i in range(0,numThreads)), 1)
+    # Have several chunks per reader even for small files, so that the work can be balanced
+    chunkSize=max(min(chunkSize, fileSize//(4*numThreads)), mega)
+    if compression(file):
+        chunks=compressedChunks(file, chunkSize)
+    else:
+        index=WikidataIndex.load(file)
+        chunks=index.chunks(chunkSize) if index else wikidataChunks(file, chunkSize)
+    numThreads=min(numThreads, len(chunks))
+    print("  Running",numThreads,"Wikidata readers on",len(chunks),"chunks", flush=True)
+    chunkQueue=Queue()
+    for index, (start, end) in enumerate(chunks):
+        chunkQueue.put((index, start, end))
+    for i in range(numThreads):
+        chunkQueue.put(None)
+    resultQueue=Queue()
+    readers=[Process(target=visitWikidataEntities, args=(i, file, visitor, chunkQueue, resultQueue)) for i in range(numThreads)]
+    for reader in readers:
+        reader.start()
+    # Results have to be taken from the queue before the readers can terminate.
+    # Progress is measured in the (compressed) bytes of the finished chunks,
+    # and of the chunks being read for compressed files
+    results={}
+    timings=[]
+    reportedSizes=defaultdict(int)
+    coveredSize=0
+    printedDots=0
+    print("  Progress ", end="", flush=True)
+    while len(results)<numThreads:
+        kind, number, content = resultQueue.get()
+        if kind=="error":
+            for reader in readers:
+                reader.terminate()
+            raise Exception(f"Wikidata reader {number+1} failed:\n{content}")
+        if kind=="result":
+            results[number]=content
+            continue
+        if kind=="progress":
+            reportedSizes[content[0]]+=content[1]
+            coveredSize+=content[1]
+        else:
+            timings.append(content)
+            coveredSize+=content[2]-content[1]-reportedSizes.pop(content[0], 0)
+        while coveredSize/fileSize*50>printedDots:
+            print(".", end="", flush=True)
+            printedDots+=1
+    print(" done", flush=True)
+    for reader in readers:
+        reader.join()
+    printChunkTimings(timings)
     print("  done", flush=True)
-    return(result)
+    return [results[number] for number in sorted(results)]
         
+##########################################################################
+#             Indexing Wikidata entities
+##########################################################################
+
+# Regex for the QID of an item line
+itemRegex=re.compile(rb'[ \t]*<http://www\.wikidata\.org/entity/Q([0-9]+)>')
+
+def qidNumber(qid):
+    """ Returns the number of a QID such as wd:Q42, Q42 or 42 """
+    if isinstance(qid, str):
+        return int(qid[qid.rindex('Q')+1:])
+    return int(qid)
+
+class WikidataIndex(object):
+    """ Byte offset and length of every Wikidata item in a Wikidata file, as numpy arrays sorted by QID.
+    An item spans from its item line to the next item line. The index is built once by indexWikidata()
+    and stored next to the file, so that later passes can split the file on item boundaries
+    and fetch single items without reading the whole file """
+    def __init__(self, file, qids, offsets, lengths):
+        self.file=file
+        self.qids=qids
+        self.offsets=offsets
+        self.lengths=lengths
+    @staticmethod
+    def indexFile(file):
+        return file+".index.npz"
+    @classmethod
+    def build(cls, file, blockSize=BLOCK):
+        """ Scans the file for item lines and returns the index """
+        qids=array('Q')
+        offsets=array('Q')
+        with open(file,"rb") as reader:
+            rest=b""
+            restStart=0
+            while True:
+                block=reader.read(blockSize)
+                if not block:
+                    break
+                data=rest+block
+                # We look only at complete lines
+                last=data.rfind(b"\n")+1
+                position=0
+                while True:
+                    found=data.find(itemSuffix, position, last)
+                    if found<0:
+                        break
+                    position=found+len(itemSuffix)
+                    if data[position:position+1] not in (b"\n", b"\r", b" "):
+                        continue
+                    lineStart=data.rfind(b"\n", 0, found)+1
+                    match=itemRegex.match(data, lineStart, found)
+                    if match:
+                        qids.append(int(match.group(1)))
+                        offsets.append(restStart+lineStart)
+                rest=data[last:]
+                restStart+=last
+        qids=np.frombuffer(qids, dtype=np.uint64).astype(np.uint32) if qids else np.zeros(0, dtype=np.uint32)
+        offsets=np.frombuffer(offsets, dtype=np.uint64) if offsets else np.zeros(0, dtype=np.uint64)
+        lengths=np.diff(offsets, append=np.uint64(os.path.getsize(file)))
+        order=np.argsort(qids, kind="stable")
+        return cls(file, qids[order], offsets[order], lengths[order])
+    @classmethod
+    def load(cls, file):
+        """ Returns the stored index of the file, or None if there is none or if it is outdated """
+        indexFile=cls.indexFile(file)
+        if not os.path.exists(indexFile):
+            return None
+        with np.load(indexFile) as data:
+            if int(data["fileSize"][0])!=os.path.getsize(file):
+                printError("Index",indexFile,"is outdated")
+                return None
+            return cls(file, data["qids"], data["offsets"], data["lengths"])
+    def save(self):
+        with open(self.indexFile(self.file), "wb") as writer:
+            np.savez(writer, qids=self.qids, offsets=self.offsets, lengths=self.lengths, fileSize=np.array([os.path.getsize(self.file)], dtype=np.uint64))
+    def __len__(self):
+        return len(self.qids)
+    def locate(self, qid):
+        """ Returns the (offset, length) of the item with the QID, or None """
+        number=qidNumber(qid)
+        i=np.searchsorted(self.qids, number)
+        if i==len(self.qids) or self.qids[i]!=number:
+            return None
+        return (int(self.offsets[i]), int(self.lengths[i]))
+    def chunks(self, chunkSize=CHUNK):
+        """ Returns the chunk index of the file as wikidataChunks() does, but without reading the file """
+        fileSize=os.path.getsize(self.file)
+        offsets=np.sort(self.offsets)
+        found=np.searchsorted(offsets, np.arange(chunkSize, fileSize, chunkSize, dtype=np.uint64))
+        starts=np.unique(np.concatenate((np.zeros(1, dtype=np.uint64), offsets[found[found<len(offsets)]]))).tolist()
+        return [(start, end) for start, end in zip(starts, starts[1:]+[fileSize]) if start<end]
+    def graphs(self, qids, predicates=None, languages=None):
+        """ Yields the graphs of the items with the QIDs (in the order of the file). Unknown QIDs are skipped """
+        locations=sorted({location for location in map(self.locate, qids) if location})
+        with open(self.file,"rb") as reader, mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ) as memory:
+            for offset, length in locations:
+                memory.seek(offset)
+                lines=NtLineReader(memory, end=offset+length)
+                # The first graph is the item; other entities may follow up to the next item
+                graph=next(entitiesFromTriples(triplesFromNtLines(lines, predicates, languages)), None)
+                if graph:
+                    yield graph
+    def graph(self, qid, predicates=None, languages=None):
+        """ Returns the graph of the item with the QID, or None """
+        return next(self.graphs([qid], predicates, languages), None)
+
+def indexWikidata(file):
+    """ Builds and stores the index of an uncompressed Wikidata file """
+    if compression(file):
+        print("  Compressed Wikidata files are read in chunks of members and need no index", flush=True)
+        return None
+    print("  Indexing",file,"...", end="", flush=True)
+    index=WikidataIndex.build(file)
+    index.save()
+    print("done,",len(index),"items", flush=True)
+    return index
+
 ##########################################################################
 #             Test
 ##########################################################################
@@ -505,6 +1163,56 @@ def compareIds(wikidataFile, idFile):
                     break
                 print(nextId, "OK")
         
+def compareParsers(ntFile):
+    """ Verifies that the N-Triples parser yields the same triples as the Turtle parser on ntFile """
+    count=0
+    for fast, slow in zip_longest(triplesFromNtFile(ntFile), triplesFromTurtleFile(ntFile)):
+        if fast!=slow:
+            print("Triple",count,"is",fast,"but should be",slow)
+            return False
+        count+=1
+    print(count,"triples OK")
+    return True
+
+def benchmarkCompaction(ntFile):
+    """ Prints the terms per second of Prefixes.compactByScan and Prefixes.compact on the IRIs of ntFile """
+    with open(ntFile,"rb") as reader:
+        terms=[term for line in NtLineReader(reader) for term in re.findall('<[^>]*>', line.decode("utf-8"))]
+    for compact in (Prefixes.compactByScan, Prefixes.compact):
+        startTime=time.perf_counter()
+        result=[compact(term) for term in terms]
+        duration=time.perf_counter()-startTime
+        print(f"{compact.__name__}: {len(terms)/duration:,.0f} terms/s")
+    if result!=[Prefixes.compactByScan(term) for term in terms]:
+        print("compact and compactByScan differ")
+
+def benchmarkEntities(ntFile):
+    """ Prints the throughput and the memory of Graph and EntityFacts for the entities of ntFile,
+    with the queries that the Wikidata visitors make """
+    triples=list(triplesFromNtFile(ntFile))
+    for factory in (Graph, EntityFacts):
+        startTime=time.perf_counter()
+        entities=0
+        for graph in entitiesFromTriples(triples, factory):
+            for p in graph.predicates():
+                graph.triplesWithPredicate(p)
+            graph.triplesWithPredicate(Prefixes.wikidataType, Prefixes.wikidataOccupation)
+            graph.subjects(Prefixes.rdfsLabel)
+            graph.objects(None, Prefixes.rdfType)
+            entities+=1
+        duration=time.perf_counter()-startTime
+        tracemalloc.start()
+        graphs=list(entitiesFromTriples(triples, factory))
+        memory=tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del graphs
+        print(f"{factory.__name__}: {entities/duration:,.0f} entities/s, {memory/max(entities,1):,.0f} bytes per entity")
+
+if TEST and __name__ == '__main__':
+    compareParsers("./wikidata.nt")
+    benchmarkCompaction("./wikidata.nt")
+    benchmarkEntities("./wikidata.nt")
+
 if __name__ == '__main__':
     with open("./sample.nt", "tw", encoding="UTF-8") as f:
         for triple in triplesFromNtFile("./wikidata.nt"):
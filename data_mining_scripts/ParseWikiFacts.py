@@ -113,29 +113,13 @@ def cleanProperties(entityFacts):
                     entityFacts.remove(t)
 
 
-def getSuperClasses(cls, classes, cleanWikiTaxonomyUp):
-    """Adds all superclasses of a class <cls> (including <cls>) to the set <classes>"""
-    classes.add(cls)
-    # Make a check before because it's a defaultdict,
-    # which would create cls if it's not there
-    if cls in cleanWikiTaxonomyUp:
-        for sc in cleanWikiTaxonomyUp[cls]:
-            getSuperClasses(sc, classes, cleanWikiTaxonomyUp)      
-
-
-def getClasses(entityFacts, cleanWikiTaxonomyUp):
-    """Returns the set of all classes and their superclasses that the subject is an instance of"""
-    classes=set()
-    for directClass in entityFacts.objects(None, Prefixes.rdfType):
-        getSuperClasses(directClass, classes, cleanWikiTaxonomyUp)        
-    return classes
-
-
-def removeRedundantDirectClasses(entityFacts, fullTransitiveClasses, cleanWikiTaxonomyUp):
+def removeRedundantDirectClasses(entityFacts, ancestors):
     """ Removes all redundant classes among the entity facts. 
-        Only keep the direct superclasses, removing the transitive ones, which are redundant. """
+        Only keep the direct superclasses, removing the transitive ones, which are redundant.
+        A direct class is transitive if it is a superclass of another direct class. """
+    directClasses = entityFacts.objects(None, Prefixes.rdfType)
     for t in entityFacts.triplesWithPredicate(Prefixes.rdfType):
-        if any(t[2] in cleanWikiTaxonomyUp[c] for c in fullTransitiveClasses):
+        if any(t[2] != c and ancestors.contains(c, t[2]) for c in directClasses):
             entityFacts.remove(t)
 
 
@@ -146,17 +130,15 @@ def removeRedundantDirectClasses(entityFacts, fullTransitiveClasses, cleanWikiTa
 class treatWikidataEntity():
     """ Visitor that will handle every Wikidata entity """
     def __init__(self,i):
-        """ We load everything once per process (!) in order to avoid problems with shared memory """
+        """ The taxonomy and its superclass closures were saved once by the main process,
+            and every process maps them read-only, so that they share the memory """
         print("    Initializing Wikidata reader",i+1, flush=True)
         self.number=i
 
-        print("    Wikidata reader",i+1, "loads Wikidata taxonomy", flush=True)
-        self.cleanWikiTaxonomyUp = defaultdict(set)
-        for triple in TsvUtils.tsvTuples("../data/wikidata/"+"wiki_taxonomy.tsv"):
-            if len(triple)>3:
-                self.cleanWikiTaxonomyUp[triple[0]].add(triple[2])
-        root = 'wd:Q35120' # entity
-        self.cleanWikiTaxonomyUp[root] = set()
+        print("    Wikidata reader",i+1, "maps Wikidata taxonomy", flush=True)
+        taxonomy = utils.load_stored_taxonomy("../data/wikidata/"+"wiki_taxonomy.tsv")
+        self.cleanWikiTaxonomyUp = taxonomy.up
+        self.ancestors = taxonomy.closure() # precomputed superclasses of all classes
 
         print("    Done initializing Wikidata reader",i+1, flush=True)
         self.writer=None
@@ -183,8 +165,7 @@ class treatWikidataEntity():
         cleanProperties(entityFacts)
         
         # removes all redundant classes of instances
-        classes = getClasses(entityFacts, self.cleanWikiTaxonomyUp) # get all superclasses of the subject entity
-        removeRedundantDirectClasses(entityFacts, classes, self.cleanWikiTaxonomyUp)
+        removeRedundantDirectClasses(entityFacts, self.ancestors)
 
         # excluding instances without meaningful properties (except for literals ones)
         props = entityFacts.predicates() - set([Prefixes.rdfType, Prefixes.rdfsLabel, Prefixes.schemaDescription])
@@ -211,15 +192,18 @@ class treatWikidataEntity():
 
 if __name__ == '__main__':
 
-    WIKIDATA_FILE = os.path.join("../data/wikidata", "latest-truthy.nt")
+    WIKIDATA_FILE = NtUtils.wikidataFile(os.path.join("../data/wikidata", "latest-truthy.nt"))
     FOLDER="../data/wikidata/"
 
     # check if the wikidata dump exists
-    if not os.path.exists(WIKIDATA_FILE):
+    if not WIKIDATA_FILE:
         raise FileNotFoundError("Please first download the latest Wikidata dump \
-                                from https://dumps.wikimedia.org/wikidatawiki/entities/ and place it in the folder 'data/wikidata/' and also decompress it.")
+                                from https://dumps.wikimedia.org/wikidatawiki/entities/ and place it in the folder 'data/wikidata/' (latest-truthy.nt, or compressed as .bz2, .gz or .zst).")
 
     with TsvUtils.Timer("Extracting Wikidata facts"):
+        print("  Storing Wikidata taxonomy...", end="", flush=True)
+        utils.store_taxonomy(FOLDER+"wiki_taxonomy.tsv")
+        print(" done")
         NtUtils.visitWikidata(WIKIDATA_FILE, treatWikidataEntity)
         print("  Collecting results...")
         count=0
@@ -24,6 +24,10 @@ from collections import defaultdict
 
 class wikidataVisitor(object):
     """ Will be called in parallel on each Wikidata entity graph, fills context[wikiTaxonomyDown]. """
+    # The only triples visit() looks at; NtUtils skips all other lines of the dump
+    predicates={Prefixes.wikidataSubClassOf, Prefixes.rdfsLabel, Prefixes.schemaDescription}
+    languages={"en"}
+
     def __init__(self, id):
         self.wikidataTaxonomyDown={} # Direct subclasses
         self.wikiTaxonomyLabels={}
@@ -57,7 +61,11 @@ class wikidataVisitor(object):
 ###########################################################################
 
 class wikidataCleaner(object):
-    """ Will be used for cleaning the built taxonomy """
+    """ Will be used for cleaning the built taxonomy.
+        A link superClass -> subClass closes a loop if subClass is a superclass of superClass (or superClass itself).
+        We keep the superclasses of the class whose subclasses we are adding in a set: they do not change
+        while we add its subclasses, and when we go down to a subclass, we only add the subclass
+        and its superclasses that are not yet in the set (and remove them when we come back up). """
     def __init__(self, cleanWikiTaxonomyDown: dict, cleanWikiTaxonomyUp: dict, wikiTaxonomyDown: dict):
         # Used for outputs
         self.cleanWikiTaxonomyDown=cleanWikiTaxonomyDown
@@ -67,37 +75,76 @@ class wikidataCleaner(object):
         self.loopCounter = 0
         self.looplength = []
     
-    def subClassInclude(self, superClass, potentialSubClass, path=[]):
-        """TRUE if the subclasses of superClass include subClass"""
+    def addSuperClasses(self, cls, superClasses):
+        """Adds cls and all its superclasses in the clean taxonomy to the set <superClasses>,
+           which already contains all superclasses of its members. Returns the list of added classes"""
+        added=[cls]
+        superClasses.add(cls)
+        stack=[cls]
+        while stack:
+            for superClass in self.cleanWikiTaxonomyUp.get(stack.pop(),[]):
+                if superClass not in superClasses:
+                    superClasses.add(superClass)
+                    added.append(superClass)
+                    stack.append(superClass)
+        return added
+    
+    def subClassInclude(self, superClass, potentialSubClass, superClasses):
+        """Returns the path from superClass down to potentialSubClass, as the first one a depth-first search finds.
+           <superClasses> are the superclasses of potentialSubClass: only they can lead to it"""
         if superClass==potentialSubClass:
-            return True, path
-        for subClass in self.cleanWikiTaxonomyDown.get(superClass,[]):
-            newpath = path + [superClass] 
-            loopDeleted, loopPath = self.subClassInclude(subClass, potentialSubClass, newpath)
-            if loopDeleted:
-                return True, loopPath
-        return False, path
+            return []
+        path=[superClass]
+        stack=[iter(self.cleanWikiTaxonomyDown.get(superClass,[]))]
+        while stack:
+            subClass=next(stack[-1], None)
+            if subClass is None:
+                stack.pop()
+                path.pop()
+            elif subClass==potentialSubClass:
+                return path
+            elif subClass in superClasses:
+                path.append(subClass)
+                stack.append(iter(self.cleanWikiTaxonomyDown.get(subClass,[])))
+        return path
     
-
-    def addSubClass(self, superClass, subClass):
-        """Adds the Wikidata classes to the wiki clean taxonomy, excluding loops"""
-        loopDeleted, loopPath = self.subClassInclude(subClass, superClass)
-        if loopDeleted:
+    def link(self, superClass, subClass, superClasses):
+        """Adds the link to the wiki clean taxonomy unless it closes a loop. Returns TRUE if added"""
+        if subClass in superClasses:
+            loopPath = self.subClassInclude(subClass, superClass, superClasses)
             self.loopCounter+=1
             loopLength = len(set(loopPath + [subClass, superClass]))
             self.looplength.append((set(loopPath + [subClass, superClass]), loopLength))
-            return
+            return False
         
         # if subClass not in CLS_SET:
         #     # not a valid class
-        #     return
+        #     return False
         self.cleanWikiTaxonomyUp[subClass].add(superClass)
         self.cleanWikiTaxonomyDown[superClass].add(subClass)
-        # Avoid adding the subclasses again in case of double inheritance -> save time
-        if subClass in self.cleanWikiTaxonomyDown:
-            return
-        for subClass2 in self.wikiTaxonomyDown.get(subClass,[]):    
-            self.addSubClass(subClass, subClass2) 
+        return True
+
+    def addSubClass(self, superClass, subClass):
+        """Adds the Wikidata classes to the wiki clean taxonomy, excluding loops"""
+        # A depth-first traversal. Every level of the stack has the links that remain to be added,
+        # and the classes it added to the superclasses of their superclass
+        superClasses=set()
+        stack=[(iter([(superClass, subClass)]), self.addSuperClasses(superClass, superClasses))]
+        while stack:
+            links, added = stack[-1]
+            link=next(links, None)
+            if link is None:
+                stack.pop()
+                superClasses.difference_update(added)
+                continue
+            superClass, subClass = link
+            if not self.link(superClass, subClass, superClasses):
+                continue
+            # Avoid adding the subclasses again in case of double inheritance -> save time
+            if subClass in self.cleanWikiTaxonomyDown:
+                continue
+            links=iter([(subClass, subClass2) for subClass2 in self.wikiTaxonomyDown.get(subClass,[])])
+            stack.append((links, self.addSuperClasses(subClass, superClasses)))
     
     # 25-04-2024: This is transfered to the cleaning process
     # # Removing shortcuts: transitive links
@@ -128,12 +175,12 @@ class wikidataCleaner(object):
 if __name__ == '__main__':
 
     OUTPUT_FOLDER = "../data/wikidata/"
-    WIKIDATA_FILE = os.path.join("../data/wikidata/", "latest-truthy.nt")
+    WIKIDATA_FILE = NtUtils.wikidataFile(os.path.join("../data/wikidata/", "latest-truthy.nt"))
 
     # check if the wikidata dump exists
-    if not os.path.exists(WIKIDATA_FILE):
+    if not WIKIDATA_FILE:
         raise FileNotFoundError("Please first download the latest Wikidata dump \
-                                from https://dumps.wikimedia.org/wikidatawiki/entities/ and place it in the folder 'data/wikidata/' and also decompress it.")
+                                from https://dumps.wikimedia.org/wikidatawiki/entities/ and place it in the folder 'data/wikidata/' (latest-truthy.nt, or compressed as .bz2, .gz or .zst).")
     
     # # loading classes or instances
     # CLS_SET = utils.read_cls(os.path.join(OUTPUT_FOLDER, "instORcls.tsv"))
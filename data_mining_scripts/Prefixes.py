@@ -39,6 +39,46 @@ prefixes = {
 "wdno": "http://www.wikidata.org/prop/novalue/",
 }
 
+##########################################################################
+#             Compacting and expanding IRIs
+##########################################################################
+
+def compactByScan(term):
+    """ Replaces the namespace of an IRI <...> by the first prefix whose URI occurs in it, or returns the IRI unchanged """
+    for prefix, uri in prefixes.items():
+        if uri in term:
+            return term.replace(uri, f"{prefix}:").replace("<", "").replace(">", "")
+    return term
+
+# All prefix URIs end with '/' or '#'. Hence, a URI can only occur in the part
+# of an IRI up to its last '/' or '#', and the compaction depends only on that part.
+# We scan the prefixes once per such namespace and remember the result.
+namespaces={}
+
+MAX_NAMESPACES=100000
+
+def compact(term):
+    """ Replaces the namespace of an IRI <...> by its prefix, or returns the IRI unchanged. Same result as compactByScan """
+    end=max(term.rfind('/'), term.rfind('#'))+1
+    namespace=term[:end]
+    compacted=namespaces.get(namespace)
+    if compacted is None:
+        if len(namespaces)>=MAX_NAMESPACES:
+            namespaces.clear()
+        compacted=compactByScan(namespace)
+        # False marks namespaces that have no prefix
+        namespaces[namespace]=compacted=compacted if compacted!=namespace else False
+    if compacted is False:
+        return term
+    return compacted+term[end:].replace("<", "").replace(">", "")
+
+def expand(term):
+    """ Replaces the prefix of a term by its namespace, e.g. wd:Q1 -> <http://www.wikidata.org/entity/Q1> """
+    prefix, colon, local = term.partition(':')
+    if colon and prefix in prefixes:
+        return "<"+prefixes[prefix]+local+">"
+    return term
+
 ##########################################################################
 #             Wikidata and schema.org URIs
 ##########################################################################
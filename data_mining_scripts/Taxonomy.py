@@ -0,0 +1,597 @@
+"""
+A compact, read-only class taxonomy
+
+Classes are interned to int32 ids, and the subclass links are stored
+as CSR arrays in both directions (superclasses and subclasses of every class).
+A Wikidata taxonomy can be saved as a folder of arrays, which processes map read-only.
+"""
+
+from collections import deque, OrderedDict
+from collections.abc import Mapping, Sequence
+from array import array
+import os
+import re
+import shutil
+import numpy as np
+import networkx as nx
+
+# The root of the Wikidata taxonomy
+ROOT="wd:Q35120"
+
+# The arrays of the links of a taxonomy, as save() and checkpoints store them
+LINK_ARRAYS=("childIds", "parentIds", "parentPointers", "parentNeighbors", "childPointers", "childNeighbors")
+
+# The arrays of a saved taxonomy, one .npy file each
+STORED_ARRAYS=("qids", "root")+LINK_ARRAYS+("ancestorStarts", "ancestorLengths")
+
+# The file with the ancestor closures of a saved taxonomy, as raw int32 values
+ANCESTORS_FILE="ancestors.int32"
+
+# The class names that a saved taxonomy can hold
+QID=re.compile(r"wd:Q[1-9][0-9]*$")
+
+##########################################################################
+#             Adjacency views
+##########################################################################
+
+class AdjacencyView(Mapping):
+    """ Read-only dict view of one direction of a Taxonomy, class -> set of classes.
+    Behaves like the defaultdict(set) that the loaders used to return:
+    the keys are the classes that have neighbors, and unknown classes map to an empty set """
+    def __init__(self, taxonomy, pointers, neighbors, extraKey=None):
+        self.taxonomy=taxonomy
+        self.pointers=pointers
+        self.neighbors=neighbors
+        self.extraKey=extraKey
+    def hasNeighbors(self, i):
+        return self.pointers[i+1]>self.pointers[i] or i==self.extraKey
+    def __getitem__(self, name):
+        i=self.taxonomy.ids.get(name)
+        if i is None:
+            return set()
+        names=self.taxonomy.names
+        return set(names[j] for j in self.neighbors[self.pointers[i]:self.pointers[i+1]].tolist())
+    def __contains__(self, name):
+        i=self.taxonomy.ids.get(name)
+        return i is not None and self.hasNeighbors(i)
+    def __iter__(self):
+        names=self.taxonomy.names
+        for i in range(len(names)):
+            if self.hasNeighbors(i):
+                yield names[i]
+    def __len__(self):
+        count=int(np.count_nonzero(np.diff(self.pointers)))
+        if self.extraKey is not None and self.pointers[self.extraKey+1]==self.pointers[self.extraKey]:
+            count+=1
+        return count
+
+##########################################################################
+#             Names of saved taxonomies
+##########################################################################
+
+class QidNames(Sequence):
+    """ Read-only list of the class names of a saved taxonomy, id -> wd:Q..., from the sorted QID numbers """
+    def __init__(self, qids):
+        self.qids=qids
+    def __getitem__(self, i):
+        return "wd:Q"+str(int(self.qids[i]))
+    def __iter__(self):
+        for qid in self.qids.tolist():
+            yield "wd:Q"+str(qid)
+    def __len__(self):
+        return len(self.qids)
+
+class QidIds(Mapping):
+    """ Read-only dict of the class ids of a saved taxonomy, wd:Q... -> id,
+    which looks up the QID number in the sorted QID numbers instead of holding a dict """
+    def __init__(self, qids):
+        self.qids=qids
+    def get(self, name, default=None):
+        number=name[4:]
+        if name[:4]!="wd:Q" or not number.isascii() or not number.isdigit() or number[:1]=="0" or len(number)>18:
+            return default
+        # A numpy scalar of the same type, so that searchsorted does not convert the array
+        number=np.uint64(number)
+        i=int(np.searchsorted(self.qids, number))
+        if i==len(self.qids) or self.qids[i]!=number:
+            return default
+        return i
+    def __getitem__(self, name):
+        i=self.get(name)
+        if i is None:
+            raise KeyError(name)
+        return i
+    def __contains__(self, name):
+        return self.get(name) is not None
+    def __iter__(self):
+        return iter(QidNames(self.qids))
+    def __len__(self):
+        return len(self.qids)
+
+##########################################################################
+#             Taxonomy
+##########################################################################
+
+def csr(sources, targets, numberOfNodes):
+    """ Returns (pointers, neighbors) of the links sources[i] -> targets[i] """
+    order=np.lexsort((targets, sources))
+    counts=np.bincount(sources, minlength=numberOfNodes)
+    pointers=np.zeros(numberOfNodes+1, dtype=np.int64)
+    np.cumsum(counts, out=pointers[1:])
+    return pointers, targets[order]
+
+class Taxonomy(object):
+    """ A class taxonomy built from (subclass, superclass) links, as they appear in the TSV files.
+    Duplicate links are dropped, and the links keep the order of their first occurrence.
+    The read-only part of the networkx.DiGraph API works as on the graph parent -> child,
+    and to_networkx() returns that graph for everything else """
+    def __init__(self, links, root=None):
+        self.ids={}
+        self.names=[]
+        childIds=array('i')
+        parentIds=array('i')
+        for child, parent in links:
+            childIds.append(self.intern(child))
+            parentIds.append(self.intern(parent))
+        self.root=self.intern(root) if root is not None else None
+        n=len(self.names)
+        childIds=np.frombuffer(childIds, dtype=np.int32)
+        parentIds=np.frombuffer(parentIds, dtype=np.int32)
+        # Drop duplicate links, in the order of their first occurrence
+        _, first=np.unique(childIds.astype(np.int64)*max(n,1)+parentIds, return_index=True)
+        first.sort()
+        self.setLinks(childIds[first], parentIds[first])
+    def setLinks(self, childIds, parentIds):
+        """ Builds the CSR arrays of the distinct links childIds[i] -> parentIds[i] """
+        n=len(self.names)
+        self.childIds=childIds
+        self.parentIds=parentIds
+        self.parentPointers, self.parentNeighbors=csr(self.childIds, self.parentIds, n)
+        self.childPointers, self.childNeighbors=csr(self.parentIds, self.childIds, n)
+        self.setViews()
+    @classmethod
+    def fromArrays(cls, names, ids, root, arrays):
+        """ Returns the taxonomy with the given names, ids (name -> id), root id and LINK_ARRAYS,
+        as stored by save() or by a binary checkpoint, without recomputing anything """
+        taxonomy=cls.__new__(cls)
+        taxonomy.names=names
+        taxonomy.ids=ids
+        taxonomy.root=root
+        for name in LINK_ARRAYS:
+            setattr(taxonomy, name, arrays[name])
+        taxonomy.setViews()
+        return taxonomy
+    def setViews(self):
+        self.up=AdjacencyView(self, self.parentPointers, self.parentNeighbors, self.root)
+        self.down=AdjacencyView(self, self.childPointers, self.childNeighbors)
+        self.depths=None
+        self.storedClosure=None
+    def intern(self, name):
+        """ Returns the id of a class, adding the class if needed """
+        i=self.ids.get(name)
+        if i is None:
+            i=len(self.names)
+            self.ids[name]=i
+            self.names.append(name)
+        return i
+    def id(self, name):
+        return self.ids[name]
+    def parentIdsOf(self, i):
+        return self.parentNeighbors[self.parentPointers[i]:self.parentPointers[i+1]]
+    def childIdsOf(self, i):
+        return self.childNeighbors[self.childPointers[i]:self.childPointers[i+1]]
+    def parents(self, name):
+        """ Returns the list of direct superclasses of a class """
+        return [self.names[j] for j in self.parentIdsOf(self.ids[name]).tolist()]
+    def children(self, name):
+        """ Returns the list of direct subclasses of a class """
+        return [self.names[j] for j in self.childIdsOf(self.ids[name]).tolist()]
+    def reachable(self, name, pointers, neighbors):
+        """ Returns the set of classes reachable from a class (including the class) """
+        start=self.ids.get(name)
+        if start is None:
+            return {name}
+        seen={start}
+        stack=[start]
+        while stack:
+            i=stack.pop()
+            for j in neighbors[pointers[i]:pointers[i+1]].tolist():
+                if j not in seen:
+                    seen.add(j)
+                    stack.append(j)
+        return set(self.names[j] for j in seen)
+    def ancestors(self, name):
+        """ Returns the set of all superclasses of a class (including the class!), as utils.getAncestors """
+        return self.reachable(name, self.parentPointers, self.parentNeighbors)
+    def descendants(self, name):
+        """ Returns the set of all subclasses of a class (including the class), as utils.getDescendants """
+        return self.reachable(name, self.childPointers, self.childNeighbors)
+    def depth(self, name):
+        """ Returns the length of the shortest path from the root to a class, or None if there is none """
+        if self.depths is None:
+            self.depths=self.computeDepths()
+        d=self.depths[self.ids[name]]
+        return None if d<0 else int(d)
+    def computeDepths(self):
+        """ Breadth-first search from the root over the subclass links """
+        depths=np.full(len(self.names), -1, dtype=np.int32)
+        if self.root is None:
+            return depths
+        depths[self.root]=0
+        queue=deque([self.root])
+        while queue:
+            i=queue.popleft()
+            for j in self.childIdsOf(i).tolist():
+                if depths[j]<0:
+                    depths[j]=depths[i]+1
+                    queue.append(j)
+        return depths
+    def to_networkx(self):
+        """ Returns the taxonomy as a networkx.DiGraph with edges parent -> child """
+        graph=nx.DiGraph()
+        graph.add_nodes_from(self.names)
+        graph.add_edges_from(self.edges())
+        return graph
+    def edges(self):
+        """ Iterator over the (parent, child) edges, as networkx.DiGraph.edges() """
+        names=self.names
+        for parent, child in zip(self.parentIds.tolist(), self.childIds.tolist()):
+            yield (names[parent], names[child])
+    def nodes(self):
+        return list(self.names)
+    def has_node(self, name):
+        return name in self.ids
+    def has_edge(self, parent, child):
+        if parent not in self.ids or child not in self.ids:
+            return False
+        neighbors=self.childIdsOf(self.ids[parent])
+        k=np.searchsorted(neighbors, self.ids[child])
+        return k<len(neighbors) and neighbors[k]==self.ids[child]
+    def number_of_nodes(self):
+        return len(self.names)
+    def number_of_edges(self):
+        return len(self.childIds)
+    def __contains__(self, name):
+        return name in self.ids
+    def __iter__(self):
+        return iter(self.names)
+    def __len__(self):
+        return len(self.names)
+    def __str__(self):
+        return "Taxonomy("+str(self.number_of_nodes())+" classes, "+str(self.number_of_edges())+" links)"
+    def closure(self, cacheSize=100000):
+        """ Returns the superclass Closure, which is the stored one if the taxonomy was loaded from a folder """
+        if self.storedClosure is not None:
+            return self.storedClosure
+        return Closure(self, cacheSize=cacheSize)
+    def save(self, folder):
+        """ Saves the taxonomy, with the superclass closures of all classes, as arrays in a folder that load() maps.
+        The classes are renumbered by QID, so that the names and ids need no dict. All classes must be QIDs """
+        for name in self.names:
+            if not QID.match(name):
+                raise ValueError("Only taxonomies of QIDs can be saved, not "+name)
+        qids=np.array([int(name[4:]) for name in self.names], dtype=np.uint64)
+        order=np.argsort(qids, kind="stable")
+        newIds=np.empty(len(order), dtype=np.int32)
+        newIds[order]=np.arange(len(order), dtype=np.int32)
+        taxonomy=Taxonomy.__new__(Taxonomy)
+        taxonomy.names=QidNames(qids[order])
+        taxonomy.ids=QidIds(taxonomy.names.qids)
+        taxonomy.root=None if self.root is None else int(newIds[self.root])
+        taxonomy.setLinks(newIds[self.childIds], newIds[self.parentIds])
+        # We write to a temporary folder first, so that readers never see a half-written taxonomy
+        temporary=folder+".tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        with open(os.path.join(temporary, ANCESTORS_FILE), "wb") as writer:
+            ancestorStarts, ancestorLengths=writeAncestors(taxonomy, writer)
+        arrays={"qids": taxonomy.names.qids, "ancestorStarts": ancestorStarts, "ancestorLengths": ancestorLengths,
+                "root": np.array([-1 if taxonomy.root is None else taxonomy.root], dtype=np.int64)}
+        for name in STORED_ARRAYS:
+            np.save(os.path.join(temporary, name+".npy"), arrays[name] if name in arrays else getattr(taxonomy, name))
+        shutil.rmtree(folder, ignore_errors=True)
+        os.replace(temporary, folder)
+    @classmethod
+    def load(cls, folder):
+        """ Returns the taxonomy saved in a folder by save(), with all arrays memory-mapped read-only,
+        so that loading is instantaneous and the processes that load the same folder share the memory """
+        arrays={name: np.load(os.path.join(folder, name+".npy"), mmap_mode="r") for name in STORED_ARRAYS}
+        root=int(arrays["root"][0])
+        taxonomy=cls.fromArrays(QidNames(arrays["qids"]), QidIds(arrays["qids"]), None if root<0 else root, arrays)
+        ancestorsFile=os.path.join(folder, ANCESTORS_FILE)
+        if os.path.getsize(ancestorsFile):
+            ancestors=np.memmap(ancestorsFile, dtype=np.int32, mode="r")
+        else:
+            ancestors=np.zeros(0, dtype=np.int32)
+        taxonomy.storedClosure=StoredClosure(taxonomy, arrays["ancestorStarts"], arrays["ancestorLengths"], ancestors)
+        return taxonomy
+
+def taxonomyOf(wikiTaxonomyUp):
+    """ Returns the Taxonomy behind a class -> superclasses dict, building one if it is a plain dict """
+    if isinstance(wikiTaxonomyUp, AdjacencyView) and wikiTaxonomyUp is wikiTaxonomyUp.taxonomy.up:
+        return wikiTaxonomyUp.taxonomy
+    return Taxonomy((c, p) for c in wikiTaxonomyUp for p in wikiTaxonomyUp[c])
+
+##########################################################################
+#             Transitive closure
+##########################################################################
+
+class Closure(object):
+    """ All superclasses (or, with down=True, all subclasses) of the classes of a Taxonomy,
+    including the class itself, as getAncestors/getDescendants compute them.
+    The closure of a class is the union of the closures of its neighbors, so we compute
+    the closures bottom-up in one iterative depth-first pass, and memoize them as sorted id arrays
+    in an LRU cache of cacheSize classes (None for no bound) """
+    def __init__(self, taxonomy, down=False, cacheSize=100000):
+        self.taxonomy=taxonomy
+        if down:
+            self.pointers, self.neighbors=taxonomy.childPointers, taxonomy.childNeighbors
+        else:
+            self.pointers, self.neighbors=taxonomy.parentPointers, taxonomy.parentNeighbors
+        self.cacheSize=cacheSize
+        self.cache=OrderedDict()
+        self.nameCache=OrderedDict()
+    def remember(self, cache, key, value):
+        cache[key]=value
+        if self.cacheSize is not None and len(cache)>self.cacheSize:
+            cache.popitem(last=False)
+    def ids(self, i):
+        """ Returns the sorted int32 array of the ids in the closure of the class with id i """
+        result=self.cache.get(i)
+        if result is not None:
+            self.cache.move_to_end(i)
+            return result
+        pointers, neighbors=self.pointers, self.neighbors
+        # Closures computed in this pass, which the LRU cache may already have dropped
+        done={}
+        onPath={i}
+        stack=[(i, neighbors[pointers[i]:pointers[i+1]].tolist())]
+        while stack:
+            node, todo=stack[-1]
+            while todo:
+                j=todo[-1]
+                if j not in done:
+                    if j not in self.cache:
+                        break
+                    done[j]=self.cache[j]
+                todo.pop()
+            if todo:
+                if j in onPath:
+                    # A loop: the classes on it share one closure, so we fall back to a plain search
+                    result=self.reachableIds(i)
+                    self.remember(self.cache, i, result)
+                    return result
+                onPath.add(j)
+                stack.append((j, neighbors[pointers[j]:pointers[j+1]].tolist()))
+                continue
+            stack.pop()
+            onPath.discard(node)
+            parts=[np.array([node], dtype=np.int32)]
+            for j in neighbors[pointers[node]:pointers[node+1]].tolist():
+                parts.append(done[j])
+            done[node]=np.unique(np.concatenate(parts)) if len(parts)>1 else parts[0]
+            self.remember(self.cache, node, done[node])
+        return done[i]
+    def reachableIds(self, i):
+        pointers, neighbors=self.pointers, self.neighbors
+        seen={i}
+        stack=[i]
+        while stack:
+            node=stack.pop()
+            for j in neighbors[pointers[node]:pointers[node+1]].tolist():
+                if j not in seen:
+                    seen.add(j)
+                    stack.append(j)
+        return np.array(sorted(seen), dtype=np.int32)
+    def of(self, name):
+        """ Returns the closure of a class as a frozenset of names; a class outside the taxonomy has only itself """
+        result=self.nameCache.get(name)
+        if result is not None:
+            self.nameCache.move_to_end(name)
+            return result
+        i=self.taxonomy.ids.get(name)
+        if i is None:
+            result=frozenset((name,))
+        else:
+            names=self.taxonomy.names
+            result=frozenset(names[j] for j in self.ids(i).tolist())
+        self.remember(self.nameCache, name, result)
+        return result
+    def contains(self, name, member):
+        """ TRUE if the class <member> is in the closure of the class <name>, without building name sets """
+        ids=self.taxonomy.ids
+        i=ids.get(name)
+        if i is None:
+            return member==name
+        j=ids.get(member)
+        if j is None:
+            return False
+        closure=self.ids(i)
+        k=np.searchsorted(closure, j)
+        return k<len(closure) and closure[k]==j
+
+class StoredClosure(Closure):
+    """ The superclass closures of a saved taxonomy, as slices of the memory-mapped array of all closures """
+    def __init__(self, taxonomy, starts, lengths, ancestors, cacheSize=1000):
+        Closure.__init__(self, taxonomy, cacheSize=cacheSize)
+        self.starts=starts
+        self.lengths=lengths
+        self.ancestors=ancestors
+    def ids(self, i):
+        start=int(self.starts[i])
+        return self.ancestors[start:start+int(self.lengths[i])]
+
+def writeAncestors(taxonomy, writer):
+    """ Writes the superclass closures of all classes (sorted int32 ids, including the class) to a binary writer,
+    and returns their (starts, lengths) in the written array. The closures are computed from the top down,
+    as the union of the closures of the superclasses, and we keep in memory only the closures of the classes
+    whose subclasses are not all done. Classes on or below a loop are done at the end by a Closure """
+    n=len(taxonomy.names)
+    starts=np.zeros(n, dtype=np.int64)
+    lengths=np.zeros(n, dtype=np.int64)
+    waiting=np.diff(taxonomy.parentPointers).tolist()
+    pending=np.diff(taxonomy.childPointers).tolist()
+    closures={}
+    written=0
+    stack=[i for i in range(n-1, -1, -1) if waiting[i]==0]
+    while stack:
+        i=stack.pop()
+        parents=taxonomy.parentIdsOf(i).tolist()
+        closure=np.array([i], dtype=np.int32)
+        if parents:
+            closure=np.unique(np.concatenate([closure]+[closures[p] for p in parents]))
+        writer.write(closure.tobytes())
+        starts[i]=written
+        lengths[i]=len(closure)
+        written+=len(closure)
+        for p in parents:
+            pending[p]-=1
+            if pending[p]==0:
+                del closures[p]
+        if pending[i]:
+            closures[i]=closure
+        for c in taxonomy.childIdsOf(i).tolist():
+            waiting[c]-=1
+            if waiting[c]==0:
+                stack.append(c)
+    closure=Closure(taxonomy)
+    for i in range(n):
+        if waiting[i]>0:
+            ids=closure.ids(i)
+            writer.write(ids.tobytes())
+            starts[i]=written
+            lengths[i]=len(ids)
+            written+=len(ids)
+    return starts, lengths
+
+##########################################################################
+#             Cumulative counts
+##########################################################################
+
+# Number of counted classes per sweep of cumulativeCounts(), a multiple of 64
+SWEEP_CLASSES=512
+
+def gather(ids, pointers, neighbors):
+    """ Returns (sources, targets) of all CSR links that start at the given ids """
+    starts=pointers[ids]
+    lengths=pointers[ids+1]-starts
+    sources=np.repeat(ids, lengths)
+    offsets=np.arange(lengths.sum())-np.repeat(np.cumsum(lengths)-lengths, lengths)
+    return sources, neighbors[np.repeat(starts, lengths)+offsets]
+
+def upwardLevels(taxonomy, ids, position):
+    """ Returns the classes above the given ids (including them), and the superclass links among them
+    grouped in levels, such that a class appears as a child only after all its subclasses did.
+    Classes are numbered by their index in the returned array; the last value is the numbers of the ids.
+    <position> is an array of -1 for all classes, which we use and restore.
+    Returns None if there is a loop """
+    pointers, neighbors=taxonomy.parentPointers, taxonomy.parentNeighbors
+    frontier=np.unique(ids)
+    position[frontier]=0
+    parts=[frontier]
+    while len(frontier):
+        _, parents=gather(frontier, pointers, neighbors)
+        frontier=np.unique(parents[position[parents]<0])
+        position[frontier]=0
+        parts.append(frontier)
+    nodes=np.concatenate(parts)
+    position[nodes]=np.arange(len(nodes))
+    # The superclass links among the nodes, as CSR arrays over the node numbers
+    lengths=pointers[nodes+1]-pointers[nodes]
+    localPointers=np.zeros(len(nodes)+1, dtype=np.int64)
+    np.cumsum(lengths, out=localPointers[1:])
+    localNeighbors=position[gather(nodes, pointers, neighbors)[1]]
+    idPositions=position[ids]
+    position[nodes]=-1
+    # Kahn's algorithm from the bottom: a class is ready when all its subclasses are done
+    waiting=np.bincount(localNeighbors, minlength=len(nodes))
+    frontier=np.flatnonzero(waiting==0)
+    levels=[]
+    done=0
+    while len(frontier):
+        done+=len(frontier)
+        children, parents=gather(frontier, localPointers, localNeighbors)
+        order=np.argsort(parents, kind='stable')
+        children, parents=children[order], parents[order]
+        targets, starts=np.unique(parents, return_index=True)
+        if len(targets):
+            levels.append((children, targets, starts))
+        np.subtract.at(waiting, parents, 1)
+        frontier=targets[waiting[targets]==0]
+    if done<len(nodes):
+        return None
+    return nodes, levels, idPositions
+
+def preorder(taxonomy, ids):
+    """ Returns the given ids in the order of a depth-first traversal of the taxonomy from the top,
+    so that classes that share many superclasses are close to each other """
+    position=np.full(len(taxonomy.names), -1, dtype=np.int64)
+    wanted=np.zeros(len(taxonomy.names), dtype=bool)
+    wanted[ids]=True
+    # The classes above the ids
+    frontier=np.unique(ids)
+    above=np.zeros(len(taxonomy.names), dtype=bool)
+    above[frontier]=True
+    while len(frontier):
+        _, parents=gather(frontier, taxonomy.parentPointers, taxonomy.parentNeighbors)
+        frontier=np.unique(parents[~above[parents]])
+        above[frontier]=True
+    tops=[i for i in np.flatnonzero(above).tolist() if taxonomy.parentPointers[i+1]==taxonomy.parentPointers[i]]
+    result=[]
+    seen=set()
+    stack=list(reversed(tops))
+    while stack:
+        i=stack.pop()
+        if i in seen:
+            continue
+        seen.add(i)
+        if wanted[i]:
+            result.append(i)
+        children=taxonomy.childIdsOf(i)
+        stack.extend(reversed(children[above[children]].tolist()))
+    # Classes on loops may have no top
+    result.extend(i for i in ids.tolist() if i not in seen)
+    return np.array(result, dtype=np.int32)
+
+def cumulativeCounts(taxonomy, ids, counts, sweepClasses=SWEEP_CLASSES):
+    """ Given distinct classes (as ids) with counts, returns (nodes, totals), where nodes are the ids
+    of all classes above the given ones (including them), and totals[k] is the sum of the counts
+    of the given classes below nodes[k] (including nodes[k]). A class reachable on several paths
+    is counted once: we give every class one bit per counted class, and OR the bits up the taxonomy
+    level by level. This is done for <sweepClasses> counted classes at a time, in depth-first order,
+    so that each sweep covers only the few classes above them.
+    Returns None if the taxonomy has a loop """
+    ids=np.asarray(ids, dtype=np.int32)
+    counts=np.asarray(counts, dtype=np.int64)
+    countOf=np.zeros(len(taxonomy.names), dtype=np.int64)
+    countOf[ids]=counts
+    ids=preorder(taxonomy, ids)
+    totals=np.zeros(len(taxonomy.names), dtype=np.int64)
+    covered=np.zeros(len(taxonomy.names), dtype=bool)
+    position=np.full(len(taxonomy.names), -1, dtype=np.int64)
+    # table[v] has a 1 in column j if bit j of the byte value v is set
+    table=np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1, bitorder='little').astype(np.int64)
+    words=(sweepClasses+63)//64
+    for first in range(0, len(ids), 64*words):
+        sweepIds=ids[first:first+64*words]
+        sweep=upwardLevels(taxonomy, sweepIds, position)
+        if sweep is None:
+            return None
+        nodes, levels, idPositions=sweep
+        bits=np.zeros((len(nodes), words), dtype=np.uint64)
+        bit=np.arange(len(sweepIds))
+        bits[idPositions, bit//64]=np.left_shift(np.uint64(1), (bit%64).astype(np.uint64))
+        for children, targets, starts in levels:
+            bits[targets]|=np.bitwise_or.reduceat(bits[children], starts, axis=0)
+        # Sum the counts of the set bits, one byte at a time through a table of 256 sums per byte
+        byteCounts=np.zeros(words*64, dtype=np.int64)
+        byteCounts[:len(sweepIds)]=countOf[sweepIds]
+        sums=byteCounts.reshape(words*8, 8)@table.T
+        octets=bits.astype('<u8', copy=False).view(np.uint8)
+        sweepTotals=np.zeros(len(nodes), dtype=np.int64)
+        for k in range(words*8):
+            sweepTotals+=sums[k][octets[:, k]]
+        totals[nodes]+=sweepTotals
+        covered[nodes]=True
+    nodes=np.flatnonzero(covered)
+    return nodes, totals[nodes]
@@ -5,6 +5,7 @@ CC-BY 2022 Fabian M. Suchanek
 """
 
 import gzip
+import bz2
 import os
 import datetime
 try:
@@ -26,23 +27,32 @@ BUFFER=1*giga
 ##########################################################################
 
 def linesOfFile(file, message=None):
-    """ Iterator over the lines of a GZ or text file, with progress bar """
+    """ Iterator over the lines of a GZ, BZ2 or text file, with progress bar.
+    For compressed files, the progress is measured in compressed bytes """
     if message:
         print(message,"...", end="", flush=True)
     totalNumberOfDots=60-len(message) if message else 0
     coveredSize=0
     printedDots=0
     fileSize=os.path.getsize(file)
-    isGZ=file.endswith(".gz")
-    if isGZ:
-        fileSize*=20
-    with (gzip.open(file, mode='rt', encoding='UTF-8') if isGZ else open(file, mode='rt', encoding='UTF-8', buffering=BUFFER)) as input:
-        for line in input:
-            coveredSize+=len(line)
-            while message and (coveredSize / fileSize * totalNumberOfDots > printedDots):
-                print(".", end="", flush=True)
-                printedDots+=1
-            yield line
+    isCompressed=file.endswith(".gz") or file.endswith(".bz2")
+    if isCompressed:
+        compressedInput=open(file, mode='rb', buffering=mega)
+        input=(gzip if file.endswith(".gz") else bz2).open(compressedInput, mode='rt', encoding='UTF-8')
+    else:
+        input=open(file, mode='rt', encoding='UTF-8', buffering=BUFFER)
+    try:
+        with input:
+            for line in input:
+                coveredSize=compressedInput.tell() if isCompressed else coveredSize+len(line)
+                while message and (coveredSize / fileSize * totalNumberOfDots > printedDots):
+                    print(".", end="", flush=True)
+                    printedDots+=1
+                yield line
+    finally:
+        # also when the iterator is closed early or the reading fails
+        if isCompressed:
+            compressedInput.close()
     while message and (coveredSize / (fileSize+1) * totalNumberOfDots > printedDots):
         print(".", end="", flush=True)
         printedDots+=1
@@ -1,6 +1,9 @@
 #!/bin/bash
 # Run Python scripts sequentially
 
+echo "Indexing the Wikidata dump..."
+python -c "import NtUtils; NtUtils.indexWikidata(NtUtils.wikidataFile('../data/wikidata/latest-truthy.nt'))"
+
 echo "Identify Instances Or Classes..."
 python InstanceVSclass.py
 
@@ -10,7 +10,7 @@ from tqdm import tqdm
 def clean_facts(folder):
 
     print("Loading the Taxonomy data...")
-    wikiTaxonDown, _ = utils.load_taxonomy(os.path.join(folder, "wiki_taxonomy.tsv"))
+    wikiTaxonDown = utils.load_taxonomy(os.path.join(folder, "wiki_taxonomy.tsv")).down
     cls_discard = utils.getDescendants(ScholarlyArticle, wikiTaxonDown)
 
     print("Creating the dataset...")
@@ -76,7 +76,8 @@ if __name__ == "__main__":
     CLS_SET = utils.read_cls(os.path.join(PATH, "instORcls.tsv"))
 
     # Differentiate the classes from instances
-    oriwikiDown, oriwikiUp = utils.load_taxonomy(os.path.join(PATH, "wiki_taxonomy.tsv"))
+    oriwiki = utils.load_taxonomy(os.path.join(PATH, "wiki_taxonomy.tsv"))
+    oriwikiDown, oriwikiUp = oriwiki.down, oriwiki.up
     wikiTaxonomyDown, wikiTaxonomyUp = defaultdict(set), defaultdict(set)
     root = 'wd:Q35120' # entity
     topClasses = oriwikiDown.get(root, []) # set of top-classes
@@ -5,8 +5,8 @@ from tqdm import tqdm
 
 
 FOLDER = "../data/wikidata/"
-wikiTaxonDown, wikiTaxonUp = utils.load_taxonomy(os.path.join(FOLDER, "noisy_WiKC.tsv"))
-topgraph = nx.DiGraph(wikiTaxonDown)
+taxonomy = utils.load_taxonomy(os.path.join(FOLDER, "noisy_WiKC.tsv"))
+topgraph = taxonomy.to_networkx()
 
 # Calculate the statistics
 print("Calculating Statistics...", end="", flush=True) 
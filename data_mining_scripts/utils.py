@@ -1,9 +1,11 @@
 try:
     from . import Prefixes
     from . import TsvUtils
+    from .Taxonomy import Taxonomy, Closure, taxonomyOf, cumulativeCounts, ROOT
 except ImportError:
     import Prefixes
     import TsvUtils
+    from Taxonomy import Taxonomy, Closure, taxonomyOf, cumulativeCounts, ROOT
 from collections import defaultdict
 from time import time
 import networkx as nx
@@ -17,14 +19,22 @@ ScholarlyArticle = "wd:Q13442814" # Discard this class
 
 def load_taxonomy(file):
     # load wiki_taxonomy.tsv, <s, p, o, .>
-    wikiTaxonomyDown = defaultdict(set)
-    wikiTaxonomyUp = defaultdict(set)
-    for triple in TsvUtils.tsvTuples(file):
-        if len(triple) > 3:
-            wikiTaxonomyDown[triple[2]].add(triple[0])
-            wikiTaxonomyUp[triple[0]].add(triple[2])
-    wikiTaxonomyUp["wd:Q35120"] = set() # add root node
-    return wikiTaxonomyDown, wikiTaxonomyUp
+    # taxonomy.down and taxonomy.up are the class -> subclasses and class -> superclasses dicts
+    links = ((triple[0], triple[2]) for triple in TsvUtils.tsvTuples(file) if len(triple) > 3)
+    return Taxonomy(links, root=ROOT) # root node is kept even without links
+
+
+def store_taxonomy(file):
+    # save the taxonomy of wiki_taxonomy.tsv as memory-mapped arrays in <file>.taxonomy, unless they are up to date
+    folder = file + ".taxonomy"
+    if not os.path.exists(folder) or os.path.getmtime(folder) < os.path.getmtime(file):
+        load_taxonomy(file).save(folder)
+    return folder
+
+
+def load_stored_taxonomy(file):
+    # map the taxonomy saved by store_taxonomy(file): instantaneous, and shared by all processes
+    return Taxonomy.load(file + ".taxonomy")
 
 
 def load_label(path):
@@ -51,7 +61,7 @@ def load_desc(path):
 
 def truncateTaxonomy(wikiTaxonomyDown, root, depth=7):
     """ Remove classes that are deeper than the given depth"""
-    taxonDAG = nx.DiGraph(wikiTaxonomyDown)
+    taxonDAG = nx.DiGraph(dict(wikiTaxonomyDown))
     depth_dict = nx.shortest_path_length(taxonDAG, source=root)
 
     cls_discard = getDescendants(ScholarlyArticle, wikiTaxonomyDown)
@@ -73,12 +83,7 @@ def truncateTaxonomy(wikiTaxonomyDown, root, depth=7):
 # Useful functions for Clean Taxonomy 
 def getSuperClasses(cls, classes, WikiTaxonomyUp):
     """Adds all superclasses of a class <cls> (including <cls>) to the set <classes>"""
-    classes.add(cls)
-    # Make a check before because it's a defaultdict,
-    # which would create cls if it's not there
-    if cls in WikiTaxonomyUp:
-        for sc in WikiTaxonomyUp[cls]:
-            getSuperClasses(sc, classes, WikiTaxonomyUp)      
+    reach(cls, classes, WikiTaxonomyUp)
 
 
 def getAncestors(cls, WikiTaxonomyUp):
@@ -90,12 +95,7 @@ def getAncestors(cls, WikiTaxonomyUp):
 
 def getSubClasses(cls, classes, WikiTaxonomyDown):
     """Adds all subclasses of a class <cls> (including <cls>) to the set <classes>"""
-    classes.add(cls)
-    # Make a check before because it's a defaultdict,
-    # which would create cls if it's not there
-    if cls in WikiTaxonomyDown:
-        for sc in WikiTaxonomyDown[cls]:
-            getSubClasses(sc, classes, WikiTaxonomyDown)
+    reach(cls, classes, WikiTaxonomyDown)
 
 
 def getDescendants(cls, WikiTaxonomyDown):
@@ -105,16 +105,67 @@ def getDescendants(cls, WikiTaxonomyDown):
     return classes
 
 
+def reach(cls, classes, WikiTaxonomy):
+    """Adds <cls> and all classes reachable from it to the set <classes>, without recursion"""
+    stack = [cls]
+    classes.add(cls)
+    while stack:
+        c = stack.pop()
+        # Make a check before because it's a defaultdict,
+        # which would create c if it's not there
+        if c in WikiTaxonomy:
+            for sc in WikiTaxonomy[c]:
+                if sc not in classes:
+                    classes.add(sc)
+                    stack.append(sc)
+
+
 def cumulative_stats(stats, TaxonomyUp):
-    """Cumulative statistics of classes"""
+    """Cumulative statistics of classes: the count of a class plus the counts of all its subclasses"""
+    taxonomy = taxonomyOf(TaxonomyUp)
+    cum_stats = defaultdict(int)
+    known = [cls for cls in stats.keys() if cls in taxonomy.ids]
+    result = cumulativeCounts(taxonomy, [taxonomy.ids[cls] for cls in known], [stats[cls] for cls in known])
+    if result is None:
+        # The taxonomy has a loop, so there is no bottom-up order
+        return cumulative_stats_by_closure(stats, taxonomy)
+    nodes, totals = result
+    for i, total in zip(nodes.tolist(), totals.tolist()):
+        cum_stats[taxonomy.names[i]] = total
+    for cls in stats.keys():
+        if cls not in taxonomy.ids:
+            cum_stats[cls] += stats[cls] # a class without superclasses
+    return cum_stats
+
+
+def cumulative_stats_by_closure(stats, taxonomy):
+    """Cumulative statistics of classes, one ancestor set per instantiated class"""
+    ancestors = Closure(taxonomy, cacheSize=None) # including cls itself
     cum_stats = defaultdict(int)
     for instantiated_cls in stats.keys():
-        ancestors = getAncestors(instantiated_cls, TaxonomyUp) # including cls itself
-        for ancestor in ancestors:
+        for ancestor in ancestors.of(instantiated_cls):
             cum_stats[ancestor] += stats[instantiated_cls]
     return cum_stats
 
 
+def benchmark_cumulative_stats(taxonomy_file, count_file):
+    """Compares cumulative_stats with the per-class closure on a taxonomy TSV and a cls_inst_count.txt file"""
+    taxonomy = load_taxonomy(taxonomy_file)
+    stats = {}
+    with open(count_file, 'r') as f:
+        for line in f:
+            cls, count = line.rstrip('\n').split('\t')
+            stats[cls] = int(count)
+    print(f'{taxonomy}, {len(stats)} instantiated classes')
+    start = time()
+    by_closure = cumulative_stats_by_closure(stats, taxonomy)
+    print(f'cumulative_stats_by_closure: {time() - start:.2f}s')
+    start = time()
+    by_sweep = cumulative_stats(stats, taxonomy.up)
+    print(f'cumulative_stats: {time() - start:.2f}s')
+    print('Same results:', by_closure == by_sweep)
+
+
 # Useful functions for Statistics calucaltion
 def prop_mentions(file_path):
     return parallel_read(file_path, count_properties)
@@ -262,4 +313,5 @@ def read_cls(file):
 
 if __name__ == '__main__':
     # measure(serial_read, 'input.txt')
+    # benchmark_cumulative_stats('../data/wikidata/wiki_taxonomy.tsv', '../data/wikidata/cls_inst_count.txt')
     measure(parallel_read, 'input.txt')
@@ -2,29 +2,143 @@ from collections import defaultdict
 from huggingface_hub import login
 import pandas as pd
 import os
+import time
+import math
+import random
+import statistics
 from configparser import ConfigParser
 from tqdm import tqdm
 import logging
+import contextlib
 from utils import *
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
 
-def infer(llm, prompt):
-    # default settings
-    generation_kwargs = {
-        "max_new_tokens": 11,
-        "return_full_text": False,
-        "do_sample": False,
-        "repetition_penalty": 1.1,
-        "batch_size": 512,
-    }
+# default settings
+GENERATION_KWARGS = {
+    "max_new_tokens": 11,
+    "return_full_text": False,
+    "do_sample": False,
+    "repetition_penalty": 1.1,
+}
+# the settings of infer() as they enter the keys of the prompt cache
+CACHE_SETTINGS = dict(GENERATION_KWARGS, add_generation_prompt=True)
+
+
+def infer(llm, prompt, prefix_cache=None):
+    generation_kwargs = dict(GENERATION_KWARGS, batch_size=512)
     messages = [{"role": "user",
                  "content": prompt}]
     input = llm.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=True)
+    if prefix_cache is not None:
+        return prefix_cache.generate([input], **generation_kwargs)[0]
     outputs = llm(input, **generation_kwargs)
     return outputs[0]["generated_text"]
 
 
+def infer_batched(llm, prompts, batch_size, max_new_tokens, prefix_cache=None):
+    '''
+    Generate the judge answers to a list of prompts with true batching, and return them in the order of the prompts.
+    The prompts go to the pipeline (or to the prefix_cache) sorted by token length, longest first, so that a batch needs little padding.
+    '''
+    generation_kwargs = dict(GENERATION_KWARGS, max_new_tokens=max_new_tokens)
+    if not prompts:
+        return []
+    inputs = [llm.tokenizer.apply_chat_template([{"role": "user", "content": prompt}], tokenize=False, add_generation_prompt=True)
+              for prompt in prompts]
+    lengths = [len(ids) for ids in llm.tokenizer(inputs, add_special_tokens=False)['input_ids']]
+    order = sorted(range(len(inputs)), key=lambda i: lengths[i], reverse=True)
+    answers = [None] * len(inputs)
+    if prefix_cache is not None:
+        for start in range(0, len(order), batch_size):
+            batch = order[start:start+batch_size]
+            for i, answer in zip(batch, prefix_cache.generate([inputs[i] for i in batch], **generation_kwargs)):
+                answers[i] = answer
+    else:
+        outputs = llm((inputs[i] for i in order), batch_size=batch_size, **generation_kwargs)
+        for i, output in zip(order, outputs):
+            answers[i] = output[0]["generated_text"]
+    return answers
+
+
+def judge_label(res):
+    # post-processing of the judge answer
+    if res.find('True') > 0:
+        return 'True'
+    if res.find('False') > 0:
+        return 'False'
+    print(res)
+    return 'None'
+
+
+def read_eval_chunks(eval_file, chunk_size):
+    # the (inst, label_inst, desc_inst, cls, depth) lines of the eval file, in lists of chunk_size lines
+    chunk = []
+    with open(eval_file, 'r') as file:
+        for line in file:
+            inst, label_inst, desc_inst, cls, depth = line.strip().split('\t')
+            chunk.append((inst, label_inst[1:-1], desc_inst[1:-1], cls, depth))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
+
+def judge_sequential(llm, eval_file, writer, cls2label, cls2desc, prompt_template, cache=None, prefix_cache=None):
+    with open(eval_file, 'r') as file:
+        for line in file:
+            inst, label_inst, desc_inst, cls, depth = line.strip().split('\t')
+            label_inst = label_inst[1:-1]
+            desc_inst = desc_inst[1:-1]
+
+            # prompting
+            if cls not in cls2desc:
+                continue
+            prompt = prompt_template.format(entity=label_inst, entity_desc=desc_inst, 
+                                type=cls2label[cls], type_desc=cls2desc[cls])
+            res = cached(cache, prompt_template, prompt, cache_settings(CACHE_SETTINGS, prefix_cache), lambda: infer(llm, prompt, prefix_cache))
+            writer.write(f"{inst}\t{cls}\t{depth}\t{judge_label(res)}\n")
+
+
+def judge_batched(config, llm, eval_file, writer, cls2label, cls2desc, prompt_template, cache=None, prefix_cache=None):
+    '''
+    Batched version of the evaluation: the eval file is streamed in chunks of chunk_size lines,
+    the prompts of a chunk that are not in the cache are generated in batches of batch_size,
+    and the results are written in the order of the eval file.
+    '''
+    batch_size = config.getint('Inference', 'batch_size', fallback=64)
+    chunk_size = config.getint('Inference', 'chunk_size', fallback=4096)
+    max_new_tokens = config.getint('Evals', 'max_new_tokens', fallback=GENERATION_KWARGS['max_new_tokens'])
+    settings = cache_settings(dict(CACHE_SETTINGS, max_new_tokens=max_new_tokens), prefix_cache)
+    examples = 0
+    start = time.time()
+
+    print(f"Start batched evaluation (batch size {batch_size}, chunks of {chunk_size} lines)...")
+    for chunk in tqdm(read_eval_chunks(eval_file, chunk_size), desc='Chunks'):
+        chunk = [(inst, label_inst, desc_inst, cls, depth) for inst, label_inst, desc_inst, cls, depth in chunk if cls in cls2desc]
+        prompts = [prompt_template.format(entity=label_inst, entity_desc=desc_inst, type=cls2label[cls], type_desc=cls2desc[cls])
+                   for _, label_inst, desc_inst, cls, _ in chunk]
+        answers = [None] * len(prompts)
+        if cache is not None:
+            keys = [cache.key(prompt_template, prompt, settings) for prompt in prompts]
+            answers = [cache.get(key) for key in keys]
+        todo = [k for k, answer in enumerate(answers) if answer is None]
+        chunk_time = time.time()
+        for k, answer in zip(todo, infer_batched(llm, [prompts[k] for k in todo], batch_size, max_new_tokens, prefix_cache)):
+            answers[k] = answer
+            if cache is not None:
+                cache.put(keys[k], answer)
+        for (inst, _, _, cls, depth), res in zip(chunk, answers):
+            writer.write(f"{inst}\t{cls}\t{depth}\t{judge_label(res)}\n")
+        writer.flush()
+        print(f"     {len(todo)} examples generated in {time.time() - chunk_time:.1f}s: "
+              f"{len(todo)/max(time.time() - chunk_time, 1e-9):.2f} examples/s")
+        examples += len(chunk)
+    elapsed = max(time.time() - start, 1e-9)
+    print(f"Done. {examples} examples in {elapsed:.1f}s: {examples/elapsed:.2f} examples/s")
+
+
 def acc_per_depth(res_path):
     total_number_per_depth = defaultdict(int)
     correct_number_per_depth = defaultdict(int)
@@ -80,6 +194,118 @@ def acc_per_depth(res_path):
     print(f"Macro: {macro_correct/macro_total:.2f} ({macro_correct}/{macro_total})")
 
 
+# stratified evaluation with early stopping
+DEPTH_BUCKETS = ["0-5", "5-10", "10-20"]
+
+
+def depth_bucket(depth):
+    # the bucket of acc_per_depth
+    if depth < 5:
+        return "0-5"
+    if depth < 10:
+        return "5-10"
+    return "10-20"
+
+
+def wilson_interval(correct, total, z=1.96):
+    # Wilson score interval of the accuracy correct/total
+    if total == 0:
+        return 0.0, 1.0
+    p = correct / total
+    center = (p + z * z / (2 * total)) / (1 + z * z / total)
+    half = z * math.sqrt(p * (1 - p) / total + z * z / (4 * total * total)) / (1 + z * z / total)
+    return max(0.0, center - half), min(1.0, center + half)
+
+
+def index_eval_buckets(eval_file, cls2desc):
+    # the byte offsets of the judged lines (cls with a description) of the eval file, per depth bucket
+    offsets = {bucket: [] for bucket in DEPTH_BUCKETS}
+    with open(eval_file, 'rb') as file:
+        offset = 0
+        for line in file:
+            fields = line.rstrip(b'\n').split(b'\t')
+            if fields[3].decode('utf-8') in cls2desc:
+                offsets[depth_bucket(int(fields[4]))].append(offset)
+            offset += len(line)
+    return offsets
+
+
+def judge_sampled(config, llm, eval_file, writer, cls2label, cls2desc, prompt_template, cache=None, prefix_cache=None):
+    '''
+    Estimate the accuracy per depth bucket on a stratified random sample of the eval file:
+    each bucket draws rounds of sample_round examples (judged in batches), updates the Wilson interval of its accuracy,
+    and stops once the interval is narrower than interval_width (after at least min_samples examples) or the bucket is exhausted.
+    The judged examples are written as in the full evaluation; as the buckets are sampled at different rates,
+    the overall accuracy is the mean of the bucket accuracies weighted by the bucket sizes (not acc_per_depth's pooled one).
+    '''
+    batch_size = config.getint('Inference', 'batch_size', fallback=64)
+    max_new_tokens = config.getint('Evals', 'max_new_tokens', fallback=GENERATION_KWARGS['max_new_tokens'])
+    interval_width = config.getfloat('Evals', 'interval_width', fallback=0.05)
+    z = statistics.NormalDist().inv_cdf(0.5 + config.getfloat('Evals', 'confidence', fallback=0.95) / 2)
+    min_samples = config.getint('Evals', 'min_samples', fallback=30)
+    sample_round = config.getint('Evals', 'sample_round', fallback=256)
+    settings = cache_settings(dict(CACHE_SETTINGS, max_new_tokens=max_new_tokens), prefix_cache)
+
+    offsets = index_eval_buckets(eval_file, cls2desc)
+    rng = random.Random(config.getint('Evals', 'seed', fallback=0))
+    for bucket in DEPTH_BUCKETS:
+        rng.shuffle(offsets[bucket])
+    counts = {bucket: {"total": 0, "correct": 0, "available": len(offsets[bucket])} for bucket in DEPTH_BUCKETS}
+    active = [bucket for bucket in DEPTH_BUCKETS if offsets[bucket]]
+    start = time.time()
+
+    with open(eval_file, 'rb') as file:
+        while active:
+            # one round: the next examples of every active bucket, judged together
+            sample = []
+            for bucket in active:
+                taken = counts[bucket]["total"]
+                for offset in offsets[bucket][taken:taken+sample_round]:
+                    file.seek(offset)
+                    inst, label_inst, desc_inst, cls, depth = file.readline().decode('utf-8').strip().split('\t')
+                    sample.append((bucket, inst, label_inst[1:-1], desc_inst[1:-1], cls, depth))
+            prompts = [prompt_template.format(entity=label_inst, entity_desc=desc_inst, type=cls2label[cls], type_desc=cls2desc[cls])
+                       for _, _, label_inst, desc_inst, cls, _ in sample]
+            answers = [None] * len(prompts)
+            if cache is not None:
+                keys = [cache.key(prompt_template, prompt, settings) for prompt in prompts]
+                answers = [cache.get(key) for key in keys]
+            todo = [k for k, answer in enumerate(answers) if answer is None]
+            for k, answer in zip(todo, infer_batched(llm, [prompts[k] for k in todo], batch_size, max_new_tokens, prefix_cache)):
+                answers[k] = answer
+                if cache is not None:
+                    cache.put(keys[k], answer)
+
+            for (bucket, inst, _, _, cls, depth), res in zip(sample, answers):
+                res = judge_label(res)
+                writer.write(f"{inst}\t{cls}\t{depth}\t{res}\n")
+                counts[bucket]["total"] += 1
+                if res in ("True", "None"): # as in acc_per_depth
+                    counts[bucket]["correct"] += 1
+            writer.flush()
+
+            for bucket in list(active):
+                total, correct = counts[bucket]["total"], counts[bucket]["correct"]
+                low, high = wilson_interval(correct, total, z)
+                if total >= counts[bucket]["available"] or (total >= min_samples and high - low < interval_width):
+                    active.remove(bucket)
+
+    judged = 0
+    weighted = 0
+    for bucket in DEPTH_BUCKETS:
+        total, correct = counts[bucket]["total"], counts[bucket]["correct"]
+        judged += total
+        if total > 0:
+            low, high = wilson_interval(correct, total, z)
+            weighted += counts[bucket]["available"] * correct / total
+            print(f"{bucket}: {correct/total:.2f} [{low:.2f}, {high:.2f}] ({correct}/{total}, of {counts[bucket]['available']})")
+    available = sum(counts[bucket]["available"] for bucket in DEPTH_BUCKETS)
+    if available > 0:
+        print(f"Overall (weighted by bucket size): {weighted/available:.2f}")
+    print(f"Judged {judged} of {available} examples in {time.time() - start:.1f}s")
+    return counts
+
+
 
 
 if __name__ == '__main__':
@@ -89,6 +315,11 @@ if __name__ == '__main__':
 
     eval_file = config.get('Evals', 'Wiki_eval')
     save_file = config.get('Evals', 'Wiki_eval').split('/')[-1]
+    sampling = config.getboolean('Evals', 'sampling', fallback=False)
+    if sampling:
+        # the sample must not overwrite the full evaluation
+        name, ext = os.path.splitext(save_file)
+        save_file = name + '.sample' + ext
     save_path = config.get('Evals', 'save_path')
     print("     Current Taxonomy:", config.get('Evals', 'Wiki_eval').split('/')[-1])
     print("     Save File:", save_file)
@@ -98,30 +329,19 @@ if __name__ == '__main__':
     llm, _ = load_llm(config.get('Models', 'model_id'))
     cls2label, cls2desc = load_literals(config)
     prompt_template = load_prompt_template(config.get('Evals', 'eval_prompt_template'))
+    prefix_cache = None
+    if config.getboolean('Inference', 'prefix_cache', fallback=False):
+        prefix_cache = PrefixCache(llm, prompt_template, add_generation_prompt=True)
 
-    with open(os.path.join(save_path, save_file), 'w') as writer:
-        with open(eval_file, 'r') as file:
-            for line in file:
-                inst, label_inst, desc_inst, cls, depth = line.strip().split('\t')
-                label_inst = label_inst[1:-1]
-                desc_inst = desc_inst[1:-1]
-
-                # prompting
-                if cls not in cls2desc:
-                    continue
-                prompt = prompt_template.format(entity=label_inst, entity_desc=desc_inst, 
-                                    type=cls2label[cls], type_desc=cls2desc[cls])
-                res = infer(llm, prompt)
-
-                # post-processing
-                if res.find('True') > 0:
-                    res = 'True'
-                elif res.find('False') > 0:
-                    res = 'False'
-                else:
-                    print(res)
-                    res = 'None'
-                writer.write(f"{inst}\t{cls}\t{depth}\t{res}\n")
-    # evaluate
-    print("***Evaluation Results:***")
-    acc_per_depth(os.path.join(save_path, save_file))
\ No newline at end of file
+    with open(os.path.join(save_path, save_file), 'w') as writer, \
+            open_prompt_cache(config) or contextlib.nullcontext() as cache:
+        if sampling:
+            judge_sampled(config, llm, eval_file, writer, cls2label, cls2desc, prompt_template, cache, prefix_cache)
+        elif config.getboolean('Inference', 'batched', fallback=False):
+            judge_batched(config, llm, eval_file, writer, cls2label, cls2desc, prompt_template, cache, prefix_cache)
+        else:
+            judge_sequential(llm, eval_file, writer, cls2label, cls2desc, prompt_template, cache, prefix_cache)
+    # evaluate (judge_sampled prints its own estimates, the pooled accuracy of a stratified sample is biased)
+    if not sampling:
+        print("***Evaluation Results:***")
+        acc_per_depth(os.path.join(save_path, save_file))
\ No newline at end of file
@@ -7,6 +7,8 @@ from IPython.display import SVG, display
 import networkx as nx
 from scipy.sparse import csr_matrix
 import numpy as np
+from data_mining_scripts import Prefixes
+from data_mining_scripts.Taxonomy import Taxonomy, ROOT, LINK_ARRAYS
 
 
 def bfs_edges_by_level(graph, root):
@@ -54,6 +56,155 @@ def find_non_informative_cls(graph, cls_stats):
     return redundant_nodes
 
 
+def _csr_ranges(pointers, nodes):
+    # the positions pointers[u]..pointers[u+1]-1 of the nodes, concatenated
+    starts = pointers[nodes]
+    lengths = pointers[nodes + 1] - starts
+    offsets = np.cumsum(lengths) - lengths
+    return np.repeat(starts - offsets, lengths) + np.arange(lengths.sum())
+
+
+def _depth_first_order(n, pointers, targets, sources):
+    # the nodes of a DAG in depth-first preorder from the sources (edges pointers/targets in CSR)
+    pointers = pointers.tolist()
+    targets = targets.tolist()
+    seen = bytearray(n)
+    order = []
+    stack = sources[::-1].tolist()
+    while stack:
+        node = stack.pop()
+        if seen[node]:
+            continue
+        seen[node] = 1
+        order.append(node)
+        stack.extend(reversed(targets[pointers[node]:pointers[node+1]]))
+    return np.array(order, dtype=np.int64)
+
+
+def redundant_edge_mask(n, parents, children, max_memory=2**28):
+    '''
+    Find the transitive (redundant) edges of a DAG with integer nodes, those removed by a transitive reduction.
+    The edge u -> v is redundant if v is a descendant of another child of u. The candidate targets v (nodes with
+    several parents, below a node with several children) are taken by blocks, in depth-first order: the descendants
+    in the block of their ancestors are computed as bitsets (numpy uint64 blocks), from the lowest ancestors up.
+    @param n: number of nodes (ids 0..n-1)
+    @param parents, children: integer arrays of the edges parents[i] -> children[i] (without duplicates)
+    @param max_memory: bytes for the bitsets of a block (the fewer the blocks, the faster)
+    @return: boolean array, True for the redundant edges
+    '''
+    parents = np.asarray(parents, dtype=np.int64)
+    children = np.asarray(children, dtype=np.int64)
+    redundant = np.zeros(len(parents), dtype=bool)
+    if len(parents) == 0:
+        return redundant
+    # CSR of the edges, by parent, and the reverse CSR, by child
+    order = np.lexsort((children, parents))
+    targets = children[order]
+    out_degree = np.bincount(parents, minlength=n)
+    in_degree = np.bincount(children, minlength=n)
+    pointers = np.concatenate(([0], np.cumsum(out_degree)))
+    reverse_pointers = np.concatenate(([0], np.cumsum(in_degree)))
+    reverse_sources = parents[np.argsort(children, kind='stable')]
+
+    # height of the nodes (longest path to a leaf), from the leaves up
+    height = np.full(n, -1, dtype=np.int64)
+    remaining = out_degree.copy()
+    frontier = np.flatnonzero(remaining == 0)
+    level = 0
+    while len(frontier):
+        height[frontier] = level
+        level += 1
+        above = reverse_sources[_csr_ranges(reverse_pointers, frontier)]
+        remaining -= np.bincount(above, minlength=n)
+        above = np.unique(above)
+        frontier = above[remaining[above] == 0]
+    if (height < 0).any():
+        raise ValueError('The graph is not a DAG')
+
+    # candidate targets (columns of the bitsets), in depth-first order, so that a block of them has few ancestors
+    candidates = (out_degree[parents[order]] > 1) & (in_degree[targets] > 1)
+    columns = np.unique(targets[candidates])
+    if len(columns) == 0:
+        return redundant
+    rank = np.empty(n, dtype=np.int64)
+    rank[_depth_first_order(n, pointers, targets, np.flatnonzero(in_degree == 0))] = np.arange(n)
+    columns = columns[np.argsort(rank[columns])]
+    column = np.full(n, -1, dtype=np.int64)
+    column[columns] = np.arange(len(columns))
+
+    words = max(1, min(-(-len(columns) // 64), max_memory // (8 * (n + 1))))
+    one = np.uint64(1)
+    marked = np.zeros(n, dtype=bool)
+    row = np.zeros(n, dtype=np.int64)
+    for first in range(0, len(columns), 64 * words):
+        last = min(first + 64 * words, len(columns))
+        # the ancestors of the block, by increasing height
+        ancestors = []
+        frontier = columns[first:last]
+        while len(frontier):
+            above = np.unique(reverse_sources[_csr_ranges(reverse_pointers, frontier)])
+            frontier = above[~marked[above]]
+            marked[frontier] = True
+            ancestors.append(frontier)
+        ancestors = np.concatenate(ancestors)
+        ancestors = ancestors[np.argsort(height[ancestors], kind='stable')]
+        row[ancestors] = np.arange(len(ancestors))
+        descendants = np.zeros((len(ancestors) + 1, -(-(last - first) // 64)), dtype=np.uint64) # last row: no descendant
+
+        for nodes in np.split(ancestors, np.flatnonzero(np.diff(height[ancestors])) + 1):
+            edges = _csr_ranges(pointers, nodes)
+            c = column[targets[edges]]
+            inside = (c >= first) & (c < last)
+            keep = marked[targets[edges]] | inside
+            counts = np.add.reduceat(keep.astype(np.int64), np.cumsum(out_degree[nodes]) - out_degree[nodes])
+            edges, c, inside = edges[keep], c[keep], inside[keep]
+            owners = np.repeat(np.arange(len(nodes)), counts)
+            # the descendants in the block of the children, and whether a child in the block is among them
+            below_rows = np.where(marked[targets[edges]], row[targets[edges]], len(ancestors))
+            below = np.bitwise_or.reduceat(descendants[below_rows], np.cumsum(counts) - counts, axis=0)
+            bit = (c[inside] - first).astype(np.uint64) & np.uint64(63)
+            word = (c[inside] - first) >> 6
+            redundant[order[edges[inside]]] = (below[owners[inside], word] >> bit) & one > 0
+            np.bitwise_or.at(below, (owners[inside], word), one << bit)
+            descendants[row[nodes]] = below
+        marked[ancestors] = False
+    return redundant
+
+
+def _edge_arrays(graph):
+    # (number of nodes, parent ids, child ids) of the edges of a networkx.DiGraph or Taxonomy, in the order of graph.edges()
+    if isinstance(graph, Taxonomy):
+        return len(graph.names), graph.parentIds, graph.childIds
+    ids = {node: i for i, node in enumerate(graph)}
+    edges = np.fromiter((ids[node] for edge in graph.edges() for node in edge), dtype=np.int64, count=2 * graph.number_of_edges())
+    return len(ids), edges[0::2], edges[1::2]
+
+
+def count_redundant_edges(graph, max_memory=2**28):
+    '''
+    Count the edges removed by a transitive reduction, without building the reduced graph
+    @param graph: networkx.DiGraph or Taxonomy (DAG)
+    '''
+    return int(redundant_edge_mask(*_edge_arrays(graph), max_memory=max_memory).sum())
+
+
+def transitive_reduction(graph, max_memory=2**28):
+    '''
+    Transitive reduction of a DAG, as nx.transitive_reduction but with bitsets (see redundant_edge_mask),
+    for the full Wikidata taxonomy as well. The remaining edges keep their order.
+    @param graph: networkx.DiGraph or Taxonomy, reduced to a new graph of the same type
+    '''
+    n, parents, children = _edge_arrays(graph)
+    keep = ~redundant_edge_mask(n, parents, children, max_memory=max_memory)
+    if isinstance(graph, Taxonomy):
+        reduced = Taxonomy.fromArrays(graph.names, graph.ids, graph.root, {name: getattr(graph, name) for name in LINK_ARRAYS})
+        reduced.setLinks(graph.childIds[keep], graph.parentIds[keep])
+        return reduced
+    reduced = nx.DiGraph()
+    reduced.add_nodes_from(graph)
+    reduced.add_edges_from(edge for edge, kept in zip(graph.edges(), keep.tolist()) if kept)
+    return reduced
+
 def draw_graph(graph, target, cls2label):
     '''
     Draw the graph from the target node to the root.
@@ -80,6 +231,13 @@ def draw_graph(graph, target, cls2label):
 
 
 def save_graph_checkpoint(graph, path, filename):
+    '''
+    Save the edges of a graph (networkx.DiGraph or Taxonomy) as child<TAB>parent lines,
+    or, if the filename ends with .npz, as a binary checkpoint (see save_binary_checkpoint).
+    '''
+    if filename.endswith('.npz'):
+        save_binary_checkpoint(graph, path+filename)
+        return
     with open(path+filename, 'w') as taxowriter:
         for edge in graph.edges():
             parent, child = edge
@@ -87,12 +245,135 @@ def save_graph_checkpoint(graph, path, filename):
 
 
 def load_graph_checkpoint(path, filename):
-    graph = nx.DiGraph()
+    '''
+    Load a checkpoint as a Taxonomy; use .to_networkx() to edit it.
+    The format is chosen by the extension: .npz for binary checkpoints,
+    .delta for delta checkpoints (see save_delta_checkpoint), TSV otherwise.
+    '''
+    if filename.endswith('.npz'):
+        return load_binary_checkpoint(path+filename)
+    if filename.endswith('.delta'):
+        return load_delta_checkpoint(path, filename)
+    links = []
     with open(path+filename, 'r') as taxoreader:
         for line in taxoreader:
             child, parent = line.strip().split('\t')
-            graph.add_edge(parent, child)
-    return graph
+            links.append((child, parent))
+    return Taxonomy(links, root=ROOT)
+
+
+def save_binary_checkpoint(graph, file):
+    '''
+    Save a graph (networkx.DiGraph or Taxonomy) as a .npz file with a string table of the classes
+    (UTF-8, newline-separated, in the order in which the TSV loader meets them), the root id,
+    and the int32/int64 link arrays of the Taxonomy, so that loading rebuilds nothing.
+    The edges keep the order of graph.edges(), so converting back to TSV gives the same lines.
+    '''
+    taxonomy = graph if isinstance(graph, Taxonomy) else Taxonomy(((child, parent) for parent, child in graph.edges()), root=ROOT)
+    names = '\n'.join(taxonomy.names).encode('utf-8')
+    root = -1 if taxonomy.root is None else taxonomy.root
+    arrays = {name: getattr(taxonomy, name) for name in LINK_ARRAYS}
+    with open(file, 'wb') as writer:
+        np.savez(writer, names=np.frombuffer(names, dtype=np.uint8), root=np.array([root], dtype=np.int64), **arrays)
+
+
+def load_binary_checkpoint(file):
+    '''
+    Load a checkpoint saved by save_binary_checkpoint as a Taxonomy, the same as the TSV loader would return.
+    '''
+    with np.load(file) as data:
+        names = data['names'].tobytes().decode('utf-8')
+        names = names.split('\n') if names else []
+        root = int(data['root'][0])
+        arrays = {name: data[name] for name in LINK_ARRAYS}
+    ids = dict(zip(names, range(len(names))))
+    return Taxonomy.fromArrays(names, ids, None if root < 0 else root, arrays)
+
+
+def convert_graph_checkpoint(path, source, target):
+    '''
+    Convert a checkpoint between the TSV and the binary format, e.g. 'final.tsv' -> 'final.npz'.
+    '''
+    save_graph_checkpoint(load_graph_checkpoint(path, source), path, target)
+
+
+def save_delta_checkpoint(graph, path, filename, base, merged=None):
+    '''
+    Save a graph as the changes against the checkpoint <base> of the previous stage (which may be a delta itself).
+    The file has a '#base' line, then one line per removed edge ('-', child, parent),
+    per added edge ('+', child, parent) and per merged node ('=', node, node it was merged into).
+    @param merged: dict node -> node it was merged into, e.g. the mergemap of the Merge Strategy
+    '''
+    base_edges = list(load_graph_checkpoint(path, base).edges())
+    edges = list(graph.edges())
+    base_set, edge_set = set(base_edges), set(edges)
+    with open(path+filename, 'w') as taxowriter:
+        taxowriter.write('#base\t'+base+'\n')
+        for parent, child in base_edges:
+            if (parent, child) not in edge_set:
+                taxowriter.write('-\t'+child+'\t'+parent+'\n')
+        for parent, child in edges:
+            if (parent, child) not in base_set:
+                taxowriter.write('+\t'+child+'\t'+parent+'\n')
+        for node, into in (merged or {}).items():
+            taxowriter.write('=\t'+node+'\t'+into+'\n')
+
+
+def read_delta_checkpoint(path, filename):
+    '''
+    Read a delta checkpoint as (base, added, removed, merged),
+    with the added and removed edges as lists of (parent, child), and merged as a dict node -> node.
+    '''
+    base, added, removed, merged = None, [], [], {}
+    with open(path+filename, 'r') as taxoreader:
+        for line in taxoreader:
+            fields = line.rstrip('\n').split('\t')
+            if fields[0] == '#base':
+                base = fields[1]
+            elif fields[0] == '+':
+                added.append((fields[2], fields[1]))
+            elif fields[0] == '-':
+                removed.append((fields[2], fields[1]))
+            elif fields[0] == '=':
+                merged[fields[1]] = fields[2]
+    if base is None:
+        raise ValueError(path+filename+' has no #base line')
+    return base, added, removed, merged
+
+
+def load_delta_checkpoint(path, filename):
+    '''
+    Load a delta checkpoint as a Taxonomy by replaying the deltas from the last full checkpoint.
+    The edges of the base keep their order, and the added edges come after them.
+    '''
+    base, added, removed, _ = read_delta_checkpoint(path, filename)
+    removed = set(removed)
+    edges = [edge for edge in load_graph_checkpoint(path, base).edges() if edge not in removed] + added
+    return Taxonomy(((child, parent) for parent, child in edges), root=ROOT)
+
+
+def delta_stats(path, filenames):
+    '''
+    Print the number of added and removed edges and of merged nodes of each stage
+    against the previous one, for full and delta checkpoints alike.
+    @param filenames: the checkpoints of the stages in order, e.g. ['original.tsv', 'cutting.delta', ...]
+    '''
+    stats = {}
+    previous = None
+    for filename in filenames:
+        if filename.endswith('.delta'):
+            base, added, removed, merged = read_delta_checkpoint(path, filename)
+            if base != previous:
+                raise ValueError(filename+' is a delta against '+base+', not '+str(previous))
+            stats[filename] = {'added': len(added), 'removed': len(removed), 'merged': len(merged)}
+        elif previous is not None:
+            before = set(load_graph_checkpoint(path, previous).edges())
+            after = set(load_graph_checkpoint(path, filename).edges())
+            stats[filename] = {'added': len(after - before), 'removed': len(before - after), 'merged': 0}
+        previous = filename
+    for filename, counts in stats.items():
+        print(f"{filename}: +{counts['added']} edges, -{counts['removed']} edges, {counts['merged']} merged nodes")
+    return stats
 
 
 def format_taxonomy(path, digraph):
@@ -102,9 +383,9 @@ def format_taxonomy(path, digraph):
     with open(path+'WiKC.nt', 'w') as taxowriter:
         for edge in digraph.edges():
             parent, child = edge
-            formated_child = '<http://www.wikidata.org/entity/'+child[3:]+'>'
-            formated_parent = '<http://www.wikidata.org/entity/'+parent[3:]+'>'
-            rel = '<http://www.wikidata.org/prop/direct/P279>'
+            formated_child = Prefixes.expand(child)
+            formated_parent = Prefixes.expand(parent)
+            rel = Prefixes.expand(Prefixes.wikidataSubClassOf)
             taxowriter.write(formated_child+' '+rel+' '+formated_parent+' .\n')
 
 
@@ -3,27 +3,118 @@ from configparser import ConfigParser
 from tqdm import tqdm
 import os
 import logging
-import json
+import time
+import argparse
+import contextlib
+import torch
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
 
-def infer(llm, prompt, stopping_criteria):
-    # default settings
-    generation_kwargs = {
-        "max_new_tokens": 500,
-        "return_full_text": False,
-        "do_sample": False,
-        "repetition_penalty": 1.1,
-        "stopping_criteria": stopping_criteria
-    }
+def chat_input(llm, prompt):
     messages = [{"role": "user",
                  "content": prompt}]
-    input = llm.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    return llm.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+
+
+# default settings
+GENERATION_KWARGS = {
+    "max_new_tokens": 500,
+    "return_full_text": False,
+    "do_sample": False,
+    "repetition_penalty": 1.1,
+}
+# the settings of infer() as they enter the keys of the prompt cache
+CACHE_SETTINGS = dict(GENERATION_KWARGS, stopping_criteria='set_stopping_criteria')
+
+
+def infer(llm, prompt, stopping_criteria, prefix_cache=None):
+    generation_kwargs = dict(GENERATION_KWARGS, stopping_criteria=stopping_criteria)
+    input = chat_input(llm, prompt)
+    if prefix_cache is not None:
+        return prefix_cache.generate([input], **generation_kwargs)[0]
+    utils.reset_stopping_criteria(stopping_criteria)
     outputs = llm(input, **generation_kwargs)
     return outputs[0]["generated_text"]
 
 
-def semantic_predict_by_llm(config):
+def infer_batched(llm, prompts, batch_size, stopping_criteria, max_new_tokens=500, prefix_cache=None):
+    '''
+    Generate the answers to a list of prompts with true batching, and return them in the order of the prompts.
+    The prompts go to the pipeline (or to the prefix_cache) sorted by token length, longest first, so that a batch
+    needs little padding (and an out-of-memory error shows up in the first batch). Returns (answers, stats) with the token counts.
+    '''
+    generation_kwargs = dict(GENERATION_KWARGS, max_new_tokens=max_new_tokens, stopping_criteria=stopping_criteria)
+    if not prompts:
+        return [], {'prompts': 0, 'prompt_tokens': 0, 'generated_tokens': 0}
+    inputs = [chat_input(llm, prompt) for prompt in prompts]
+    lengths = [len(ids) for ids in llm.tokenizer(inputs, add_special_tokens=False)['input_ids']]
+    order = sorted(range(len(inputs)), key=lambda i: lengths[i], reverse=True)
+    answers = [None] * len(inputs)
+    for start in range(0, len(order), batch_size):
+        # one generate() per batch, so that the stopping criteria are reset for each batch
+        batch = order[start:start+batch_size]
+        if prefix_cache is not None:
+            texts = prefix_cache.generate([inputs[i] for i in batch], **generation_kwargs)
+        else:
+            utils.reset_stopping_criteria(stopping_criteria)
+            texts = [output[0]["generated_text"] for output in llm([inputs[i] for i in batch], batch_size=batch_size, **generation_kwargs)]
+        for i, answer in zip(batch, texts):
+            answers[i] = answer
+    generated = [len(ids) for ids in llm.tokenizer(answers, add_special_tokens=False)['input_ids']]
+    return answers, {'prompts': len(inputs), 'prompt_tokens': sum(lengths), 'generated_tokens': sum(generated)}
+
+
+def infer_scores(llm, prompts, batch_size):
+    '''
+    Score the five candidate answers of each prompt instead of generating an answer (see utils.score_candidates),
+    in batches of prompts sorted by token length. Returns the (label, probabilities) of the prompts, in their order.
+    '''
+    labels = list(utils.ANSWER_CANDIDATES)
+    candidates = [utils.ANSWER_CANDIDATES[label] for label in labels]
+    inputs = [chat_input(llm, prompt) + utils.ANSWER_PREFIX for prompt in prompts]
+    lengths = [len(ids) for ids in llm.tokenizer(inputs, add_special_tokens=False)['input_ids']] if inputs else []
+    order = sorted(range(len(inputs)), key=lambda i: lengths[i], reverse=True)
+    results = [None] * len(inputs)
+    for start in range(0, len(order), batch_size):
+        batch = order[start:start+batch_size]
+        probabilities = torch.softmax(utils.score_candidates(llm, [inputs[i] for i in batch], candidates), dim=-1)
+        for i, row in zip(batch, probabilities.tolist()):
+            results[i] = (labels[row.index(max(row))], dict(zip(labels, row)))
+    return results, {'prompts': len(inputs), 'prompt_tokens': sum(lengths), 'generated_tokens': 0}
+
+
+def to_scored_record(parent, child, label, probabilities):
+    # the answer is written as the prompt asks for it, so that utils.parse_output gives back the label
+    return {
+        'cls_pairs': (parent, child),
+        'explanation': '',
+        'answer': utils.ANSWER_PREFIX + ' ' + utils.ANSWER_CANDIDATES[label],
+        'label': label,
+        'probabilities': probabilities
+    }
+
+
+def to_record(parent, child, res):
+    explain_idx = res.find('Explanation:')
+    ans_idx = res.find('Answer:')
+    return {
+        'cls_pairs': (parent, child),
+        'explanation': res[explain_idx:ans_idx].replace('\n', '').strip(),
+        'answer': res[ans_idx:].replace('\n', '').strip()
+    }
+
+
+def report_throughput(stats, elapsed):
+    elapsed = max(elapsed, 1e-9)
+    print(f"     {stats['prompts']} prompts in {elapsed:.1f}s: {stats['prompts']/elapsed:.2f} prompts/s, "
+          f"{stats['prompt_tokens']/elapsed:.1f} prompt tokens/s, {stats['generated_tokens']/elapsed:.1f} generated tokens/s")
+
+
+def semantic_predict_by_llm(config, resume=False, shard=None):
+    '''
+    @param resume: skip the cls_pairs already in the save file, and append the new results to it
+    @param shard: (i, N) to answer only the i-th of N shards of the edges, in a save file of its own
+    '''
 
     # load model and data
     try:
@@ -33,39 +124,141 @@ def semantic_predict_by_llm(config):
         print("Error loading language model:", e)
     
     cls2label, cls2desc = utils.load_literals(config)
-    hierrels = utils.load_taxonomy(config) # list of tuples (child, parent)
+    hierrels = utils.load_taxonomy(config) # Taxonomy of (child, parent) links
     prompt_template = utils.load_prompt_template(config.get('Paths', 'prompt_template'))
 
+    save_file = utils.shard_path(os.path.join('./results/', config.get('Paths', 'save_file')), shard)
+    edges = utils.select_shard(hierrels.edges(), shard)
+    if resume:
+        answered = utils.load_answered_pairs(save_file)
+        print(f"Resuming: {len(answered)} edges already answered in {save_file}")
+        edges = [edge for edge in edges if edge not in answered]
+
+    prefix_cache = None
+    if config.getboolean('Inference', 'prefix_cache', fallback=False):
+        prefix_cache = utils.PrefixCache(llm, prompt_template)
+        print(f"Prefix of the prompt template cached: {prefix_cache.prefix_ids.shape[1]} tokens")
+
+    with utils.open_prompt_cache(config) or contextlib.nullcontext() as cache:
+        if config.getboolean('Inference', 'scoring', fallback=False):
+            semantic_predict_scored(config, llm, edges, cls2label, cls2desc, prompt_template, save_file, resume)
+        elif config.getboolean('Inference', 'batched', fallback=False):
+            semantic_predict_batched(config, llm, tokenizer, edges, cls2label, cls2desc, prompt_template, save_file, resume, cache, prefix_cache)
+        else:
+            semantic_predict_sequential(llm, tokenizer, edges, cls2label, cls2desc, prompt_template, save_file, resume, cache, prefix_cache)
+
+
+def semantic_predict_sequential(llm, tokenizer, edges, cls2label, cls2desc, prompt_template, save_file, resume=False, cache=None, prefix_cache=None):
+    '''
+    One prompt at a time, with the stopping criteria of infer(); answers in the cache are not generated again.
+    '''
+    stopping_criteria = utils.set_stopping_criteria(tokenizer)
     print("Start inference...")
-    with open(os.path.join('./results/', config.get('Paths', 'save_file')), 'w') as llm_writer:
-        for child, parent in tqdm(hierrels):
+    with utils.ResultWriter(save_file, append=resume) as llm_writer:
+        for parent, child in tqdm(edges):
             prompt = prompt_template.format(
                 parent_label=cls2label[parent], parent_desc=cls2desc[parent],
                 child_label=cls2label[child], child_desc=cls2desc[child])
             
-            stopping_criteria = utils.set_stopping_criteria(tokenizer)
-            res = infer(llm, prompt, stopping_criteria)
-            explain_idx = res.find('Explanation:')
-            ans_idx = res.find('Answer:')
-            data = {
-                'cls_pairs': (parent, child),
-                'explanation': res[explain_idx:ans_idx].replace('\n', '').strip(),
-                'answer': res[ans_idx:].replace('\n', '').strip()
-            }
-            json.dump(data, llm_writer)
-            llm_writer.write('\n')
+            res = utils.cached(cache, prompt_template, prompt, utils.cache_settings(CACHE_SETTINGS, prefix_cache),
+                               lambda: infer(llm, prompt, stopping_criteria, prefix_cache))
+            llm_writer.write(to_record(parent, child, res))
             # llm_writer.write(parent + '\t' + child + '\t' + res[explain_idx:ans_idx].strip() +
             #                  '\t' + res[ans_idx:].strip() + '\n')
 
 
+def semantic_predict_batched(config, llm, tokenizer, edges, cls2label, cls2desc, prompt_template, save_file, resume=False, cache=None, prefix_cache=None):
+    '''
+    Batched version of the prediction: the (parent, child) edges are taken in chunks of chunk_size,
+    the prompts of a chunk that are not in the cache are generated in batches of batch_size,
+    and the results are written in the order of the edges.
+    '''
+    batch_size = config.getint('Inference', 'batch_size', fallback=64)
+    chunk_size = config.getint('Inference', 'chunk_size', fallback=4096)
+    max_new_tokens = config.getint('Inference', 'max_new_tokens', fallback=500)
+    settings = utils.cache_settings(dict(CACHE_SETTINGS, max_new_tokens=max_new_tokens), prefix_cache)
+    stopping_criteria = utils.set_stopping_criteria(tokenizer)
+    totals = {'prompts': 0, 'prompt_tokens': 0, 'generated_tokens': 0}
+    start = time.time()
+
+    print(f"Start batched inference (batch size {batch_size}, chunks of {chunk_size} edges)...")
+    with utils.ResultWriter(save_file, append=resume) as llm_writer:
+        for chunk_start in tqdm(range(0, len(edges), chunk_size), desc='Chunks'):
+            chunk = edges[chunk_start:chunk_start+chunk_size]
+            prompts = [prompt_template.format(
+                parent_label=cls2label[parent], parent_desc=cls2desc[parent],
+                child_label=cls2label[child], child_desc=cls2desc[child]) for parent, child in chunk]
+            answers = [None] * len(prompts)
+            if cache is not None:
+                keys = [cache.key(prompt_template, prompt, settings) for prompt in prompts]
+                answers = [cache.get(key) for key in keys]
+            todo = [k for k, answer in enumerate(answers) if answer is None]
+            chunk_time = time.time()
+            generated, stats = infer_batched(llm, [prompts[k] for k in todo], batch_size, stopping_criteria, max_new_tokens, prefix_cache)
+            report_throughput(stats, time.time() - chunk_time)
+            for k, answer in zip(todo, generated):
+                answers[k] = answer
+                if cache is not None:
+                    cache.put(keys[k], answer)
+            for (parent, child), res in zip(chunk, answers):
+                llm_writer.write(to_record(parent, child, res))
+            llm_writer.sync()
+            for key in totals:
+                totals[key] += stats[key]
+    print("Done. Overall throughput:")
+    report_throughput(totals, time.time() - start)
+
+
+def semantic_predict_scored(config, llm, edges, cls2label, cls2desc, prompt_template, save_file, resume=False):
+    '''
+    Scoring version of the prediction: no explanation is generated, the most likely of the five answers is taken,
+    and the probabilities of all five are written with it.
+    '''
+    batch_size = config.getint('Inference', 'batch_size', fallback=64)
+    chunk_size = config.getint('Inference', 'chunk_size', fallback=4096)
+    totals = {'prompts': 0, 'prompt_tokens': 0, 'generated_tokens': 0}
+    start = time.time()
+
+    print(f"Start scoring the answers (batch size {batch_size}, chunks of {chunk_size} edges)...")
+    with utils.ResultWriter(save_file, append=resume) as llm_writer:
+        for chunk_start in tqdm(range(0, len(edges), chunk_size), desc='Chunks'):
+            chunk = edges[chunk_start:chunk_start+chunk_size]
+            prompts = [prompt_template.format(
+                parent_label=cls2label[parent], parent_desc=cls2desc[parent],
+                child_label=cls2label[child], child_desc=cls2desc[child]) for parent, child in chunk]
+            chunk_time = time.time()
+            results, stats = infer_scores(llm, prompts, batch_size)
+            report_throughput(stats, time.time() - chunk_time)
+            for (parent, child), (label, probabilities) in zip(chunk, results):
+                llm_writer.write(to_scored_record(parent, child, label, probabilities))
+            llm_writer.sync()
+            for key in totals:
+                totals[key] += stats[key]
+    print("Done. Overall throughput:")
+    report_throughput(totals, time.time() - start)
+
+
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Predict the semantic relation of the taxonomy edges with an LLM.')
+    parser.add_argument('--resume', action='store_true', help='skip the edges already answered in the save file')
+    parser.add_argument('--shard', help='i/N: answer only the i-th of N shards of the edges (1 <= i <= N)')
+    parser.add_argument('--merge', type=int, metavar='N', help='merge the save files of N shards, without running the LLM')
+    args = parser.parse_args()
+
     config = ConfigParser()
     config.read('config.ini')
 
+    if args.merge:
+        edges = list(utils.load_taxonomy(config).edges())
+        utils.merge_shards(os.path.join('./results/', config.get('Paths', 'save_file')), args.merge, edges)
+        raise SystemExit
+
     print('     Current Prompt:', config.get('Paths', 'prompt_template').split('/')[-1])
     print('     Current model:', config.get('Models', 'model_id').split('/')[-1])
     print('     Current taxonomy:', config.get('Paths', 'Wiki_Taxonomy').split('/')[-1])
     print('     Current save file:', config.get('Paths', 'save_file'))
+    if args.shard:
+        print('     Current shard:', args.shard)
 
-    semantic_predict_by_llm(config)
+    semantic_predict_by_llm(config, resume=args.resume, shard=utils.parse_shard(args.shard))
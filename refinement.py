@@ -0,0 +1,284 @@
+from collections import defaultdict, deque
+from itertools import chain
+import copy
+import json
+import time
+import networkx as nx
+from tqdm import tqdm
+from utils import ANSWER_PARSER
+from graph_utils import bfs_edges_by_level, transitive_reduction
+
+
+# refinement steps of clean.ipynb
+LLM_LABELS = {'[NONE]': 'none', '[IRREL]': 'irrel', '[EQUIV]': 'equiv', '[SUBCLS]': 'subcls', '[INVERSE]': 'inverse'}
+
+
+def load_llm_results(path):
+    '''
+    Load the (parent, child) pairs of the LLM results by parsed label: none, irrel, equiv, subcls, inverse.
+    '''
+    pairs, answers = [], []
+    with open(path, 'r') as file:
+        for line in file:
+            block = json.loads(line.strip())
+            pairs.append(tuple(block["cls_pairs"])) # (parent, child)
+            answers.append(block["answer"])
+
+    llm_res = {label: [] for label in LLM_LABELS.values()}
+    for rels, ans in zip(pairs, ANSWER_PARSER.parse_many(answers)):
+        if ans not in LLM_LABELS:
+            raise ValueError(f"Answer not valid: {ans}")
+        llm_res[LLM_LABELS[ans]].append(rels)
+
+    # statistics
+    total = sum(len(rels) for rels in llm_res.values())
+    print(f"None: {len(llm_res['none'])}, Percentage: {len(llm_res['none'])/total*100:.2f}%")
+    print(f"Irrelevant: {len(llm_res['irrel'])}, Percentage: {len(llm_res['irrel'])/total*100:.2f}%")
+    print(f"Equivalent: {len(llm_res['equiv'])}, Percentage: {len(llm_res['equiv'])/total*100:.2f}%")
+    print(f"Subclass: {len(llm_res['subcls'])}, Percentage: {len(llm_res['subcls'])/total*100:.2f}%")
+    print(f"Inverse: {len(llm_res['inverse'])}, Percentage: {len(llm_res['inverse'])/total*100:.2f}%")
+    return llm_res
+
+
+def _split_component(graph, a, b):
+    '''
+    None if a and b are weakly connected, otherwise the weakly connected component of one of them.
+    The two components are searched in turn, so that the search stops as soon as one of them is exhausted.
+    '''
+    seen = ({a}, {b})
+    queues = (deque([a]), deque([b]))
+    while True:
+        for side in (0, 1):
+            if not queues[side]:
+                return seen[side]
+        side = 0 if len(seen[0]) <= len(seen[1]) else 1
+        node = queues[side].popleft()
+        for neighbor in chain(graph.successors(node), graph.predecessors(node)):
+            if neighbor in seen[1 - side]:
+                return None
+            if neighbor not in seen[side]:
+                seen[side].add(neighbor)
+                queues[side].append(neighbor)
+
+
+def _cut_off(graph, node, limit):
+    '''
+    The nodes of a DAG, reachable from the root, that are no longer reachable once node has lost its only parent:
+    node and its descendants whose parents are all cut off. Returns None as soon as there are more than limit nodes.
+    '''
+    cut = {node}
+    stack = [node]
+    while stack:
+        for child in graph.successors(stack.pop()):
+            if child not in cut and all(parent in cut for parent in graph.predecessors(child)):
+                cut.add(child)
+                stack.append(child)
+                if len(cut) > limit:
+                    return None
+    return cut
+
+
+def _weak_component(graph, node):
+    component = {node}
+    queue = deque([node])
+    while queue:
+        node = queue.popleft()
+        for neighbor in chain(graph.successors(node), graph.predecessors(node)):
+            if neighbor not in component:
+                component.add(neighbor)
+                queue.append(neighbor)
+    return component
+
+
+def cut(graph, root, edges_del):
+    '''
+    Cut Strategy: remove the edges to delete, in BFS order (first-level classes excepted).
+    The edge of a child with a single parent is only removed if the child's subgraph gets cut off
+    with at most 3 nodes, or if at most 5 nodes are no longer reachable from the root (these nodes are removed too).
+    Same result as cut_by_components, but the connectivity is checked locally: the weak connectivity by a search
+    from both ends of the removed edge, the reachability from the root by following the descendants of the child.
+    @param graph: networkx.DiGraph, a DAG whose nodes are all reachable from the root (modified in place)
+    @param edges_del: set of (parent, child) edges
+    '''
+    if not nx.is_directed_acyclic_graph(graph) or len(nx.descendants(graph, root)) != graph.number_of_nodes() - 1:
+        raise ValueError('The Cut strategy expects a DAG whose classes are all reachable from the root')
+    bfs_edges = bfs_edges_by_level(graph, root)
+    for edge in tqdm(bfs_edges, desc='Current Step (1): Cut Strategy.'):
+        parent, child = edge
+        # Skip first-level classes
+        if parent == root:
+            continue
+        if not graph.has_edge(parent, child) or edge not in edges_del:
+            continue
+
+        graph.remove_edge(parent, child)
+        if graph.in_degree(child) > 0:
+            # remove edge if child has multiple parents (it stays reachable through them)
+            continue
+
+        component = _split_component(graph, parent, child)
+        if component is not None:
+            # cut_by_components names components[0] the component of the first node of the graph
+            first_in_component = next(iter(graph)) in component
+            rest = graph.number_of_nodes() - len(component)
+            small_size, large_size = (rest, len(component)) if first_in_component else (len(component), rest)
+            if small_size < large_size and small_size < 4:
+                # remove small subgraph with <= 3 nodes
+                if first_in_component:
+                    component = _weak_component(graph, child if parent in component else parent)
+                graph.remove_nodes_from(component)
+                continue
+            graph.add_edge(parent, child)
+        else:
+            # weakly connected but having multiple roots: delete the unreachable nodes if there are at most 5
+            cut_nodes = _cut_off(graph, child, limit=5)
+            if cut_nodes is None:
+                graph.add_edge(parent, child)
+            else:
+                graph.remove_nodes_from(cut_nodes)
+    return graph
+
+
+def cut_by_components(graph, root, edges_del):
+    '''
+    Cut Strategy as first written in clean.ipynb, which checks the connectivity of the whole graph
+    for every removed edge of a child with a single parent; kept to check cut() against.
+    '''
+    bfs_edges = bfs_edges_by_level(graph, root)
+    for edge in tqdm(bfs_edges, desc='Current Step (1): Cut Strategy.'):
+        # Skip first-level classes
+        if edge[0] == root:
+            continue
+
+        if graph.has_edge(edge[0], edge[1]) and (edge in edges_del):
+            if graph.in_degree(edge[1]) > 1:
+                # remove edge if child has multiple parents
+                graph.remove_edge(edge[0], edge[1])
+                continue
+            else:
+                graph.remove_edge(edge[0], edge[1])
+                if not nx.is_weakly_connected(graph):
+                    components = list(nx.weakly_connected_components(graph))
+                    assert len(components) == 2
+                    if len(components[1]) < len(components[0]) and len(components[1]) < 4:
+                        # remove small subgraph with <= 3 nodes
+                        for node in components[1]:
+                            graph.remove_node(node)
+                        continue
+                    graph.add_edge(edge[0], edge[1])
+                elif not nx.has_path(graph, root, edge[1]):
+                    # weakly connected but having multiple roots
+                    del_nodes_set = set()
+                    for node in graph.nodes():
+                        if not nx.has_path(graph, root, node):
+                            del_nodes_set.add(node)
+                        if len(del_nodes_set) > 5:
+                            # no delete anymore
+                            graph.add_edge(edge[0], edge[1])
+                            break
+                    # delete nodes which is root unreachable
+                    if len(del_nodes_set) <= 5:
+                        for node in del_nodes_set:
+                            if graph.has_node(node):
+                                graph.remove_node(node)
+    return graph
+
+
+def compare_cut(graph, root, edges_del):
+    '''
+    Time cut() against cut_by_components() on copies of the graph, and check that they give the same edges (in the same order).
+    '''
+    start = time.time()
+    fast = cut(copy.deepcopy(graph), root, edges_del)
+    fast_time = time.time() - start
+    start = time.time()
+    reference = cut_by_components(copy.deepcopy(graph), root, edges_del)
+    reference_time = time.time() - start
+    same = list(fast.edges()) == list(reference.edges())
+    print(f"Cut: {fast_time:.1f}s, by components: {reference_time:.1f}s ({reference_time/max(fast_time, 1e-9):.0f}x), same edges: {same}")
+    return same
+
+
+def resolve(graph, root, inverse_edges):
+    '''
+    Resolve Strategy: cut the inverse edges of children with several parents, merge the other children into their parent.
+    Returns the WiKC -> Wikidata mapping of the merged classes and the cut edges.
+    '''
+    mapping = defaultdict(set) # WiKC -> Wikidata
+    bfs_edges = bfs_edges_by_level(graph, root)
+    inv_del_edges = []
+    for edge in tqdm(bfs_edges, desc='Current Step (2): Resolve Strategy.'):
+        parent, child = edge
+        if edge not in inverse_edges:
+            continue
+        if graph.has_edge(parent, child):
+            if graph.in_degree(child) > 1:
+                graph.remove_edge(parent, child) # cut edge
+                inv_del_edges.append(edge)
+            else: # merge child to parent (single parent)
+                for sc in graph.successors(child):
+                    graph.add_edge(parent, sc)
+                graph.remove_node(child)
+                # save mapping
+                mapping[parent].add(child)
+        if not nx.is_weakly_connected(graph):
+            print('Not connected if remove edge:', edge)
+            break
+    return mapping, inv_del_edges
+
+
+def merge(graph, root, equiv_edges, mapping):
+    '''
+    Merge Strategy: merge the children of equivalent edges into their parent (first-level classes excepted).
+    Returns the graph, the (parent, child) edges to reprompt and the mergemap (node -> node it was merged into),
+    and updates the mapping.
+    '''
+    equiv_edges = set(equiv_edges)
+    mergemap = {} # child -> parent merge map
+    relinkedParentTo = set() # reprompt edges
+    bfs_edges = bfs_edges_by_level(graph, root)
+    for edge in tqdm(bfs_edges, desc='Current Step (4): Merge Strategy.'):
+        # we won't merge the first-level classes
+        # e.g. entity -> object
+        if edge[0] == root:
+            continue
+        # we won't consider continuous merge
+        if not graph.has_edge(edge[0], edge[1]):
+            continue
+        if edge in equiv_edges:
+            cur = edge[1]
+            mergeTo = edge[0]
+            # find the first valid parent, avoid already merged parent
+            while mergeTo in mergemap:
+                mergeTo = mergemap[mergeTo]
+            for sc in graph.successors(cur):
+                graph.add_edge(mergeTo, sc)
+            for pc in graph.predecessors(cur):
+                # avoid duplicates and contradiction
+                if nx.has_path(graph, source=pc, target=mergeTo) or \
+                    nx.has_path(graph, source=mergeTo, target=pc):
+                    continue
+                if pc == edge[0]:
+                    continue
+                if graph.has_node(pc) and graph.has_node(mergeTo):
+                    relinkedParentTo.add(tuple([pc, mergeTo]))
+            # delete current node
+            mergemap[cur] = mergeTo
+            mapping[mergeTo].add(cur) # save mapping WiKC -> Wikidata
+            graph.remove_node(cur)
+            # transitive reduction
+            graph = transitive_reduction(graph)
+    return graph, relinkedParentTo, mergemap
+
+
+def rewire(graph, torelink_edges):
+    '''
+    Rewire Strategy: add the (parent, child) edges confirmed by reprompting, between classes that are still in the graph.
+    '''
+    for edge in tqdm(torelink_edges, desc='Current Step (5): Rewire Strategy.'):
+        parent, child = edge
+        if graph.has_node(parent) and graph.has_node(child):
+            if graph.has_edge(parent, child):
+                continue
+            graph.add_edge(parent, child)
+    return transitive_reduction(graph)
@@ -3,27 +3,37 @@ from configparser import ConfigParser
 from tqdm import tqdm
 import os
 import logging
-import json
+import argparse
+import contextlib
 logging.getLogger("transformers").setLevel(logging.ERROR)
 
 
+# default settings
+GENERATION_KWARGS = {
+    "max_new_tokens": 500,
+    "return_full_text": False,
+    "do_sample": False,
+    "repetition_penalty": 1.1,
+}
+# the settings of infer() as they enter the keys of the prompt cache (the same as in llm_predict.py)
+CACHE_SETTINGS = dict(GENERATION_KWARGS, stopping_criteria='set_stopping_criteria')
+
+
 def infer(llm, prompt, stopping_criteria):
-    # default settings
-    generation_kwargs = {
-        "max_new_tokens": 500,
-        "return_full_text": False,
-        "do_sample": False,
-        "repetition_penalty": 1.1,
-        "stopping_criteria": stopping_criteria
-    }
+    generation_kwargs = dict(GENERATION_KWARGS, stopping_criteria=stopping_criteria)
     messages = [{"role": "user",
                  "content": prompt}]
     input = llm.tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=False)
+    utils.reset_stopping_criteria(stopping_criteria)
     outputs = llm(input, **generation_kwargs)
     return outputs[0]["generated_text"]
 
 
-def semantic_predict_by_llm(config):
+def semantic_predict_by_llm(config, resume=False, shard=None):
+    '''
+    @param resume: skip the cls_pairs already in the save file, and append the new results to it
+    @param shard: (i, N) to answer only the i-th of N shards of the edges, in a save file of its own
+    '''
 
     # load model and data
     try:
@@ -36,15 +46,24 @@ def semantic_predict_by_llm(config):
     hierrels = utils.load_reprompt_edges(config) # list of tuples (child, parent)
     prompt_template = utils.load_prompt_template(config.get('Paths', 'prompt_template'))
 
+    save_file = utils.shard_path(os.path.join('./results/', config.get('Recheck', 'save_file')), shard)
+    hierrels = utils.select_shard(hierrels, shard)
+    if resume:
+        answered = utils.load_answered_pairs(save_file)
+        print(f"Resuming: {len(answered)} edges already answered in {save_file}")
+        hierrels = [(child, parent) for child, parent in hierrels if (parent, child) not in answered]
+
+    stopping_criteria = utils.set_stopping_criteria(tokenizer)
     print("Start inference...")
-    with open(os.path.join('./results/', config.get('Recheck', 'save_file')), 'w') as llm_writer:
+    with utils.ResultWriter(save_file, append=resume) as llm_writer, \
+            utils.open_prompt_cache(config) or contextlib.nullcontext() as cache:
         for child, parent in tqdm(hierrels):
             prompt = prompt_template.format(
                 parent_label=cls2label[parent], parent_desc=cls2desc[parent],
                 child_label=cls2label[child], child_desc=cls2desc[child])
             
-            stopping_criteria = utils.set_stopping_criteria(tokenizer)
-            res = infer(llm, prompt, stopping_criteria)
+            res = utils.cached(cache, prompt_template, prompt, CACHE_SETTINGS,
+                               lambda: infer(llm, prompt, stopping_criteria))
             explain_idx = res.find('Explanation:')
             ans_idx = res.find('Answer:')
             data = {
@@ -52,20 +71,32 @@ def semantic_predict_by_llm(config):
                 'explanation': res[explain_idx:ans_idx].replace('\n', '').strip(),
                 'answer': res[ans_idx:].replace('\n', '').strip()
             }
-            json.dump(data, llm_writer)
-            llm_writer.write('\n')
+            llm_writer.write(data)
             # llm_writer.write(parent + '\t' + child + '\t' + res[explain_idx:ans_idx].strip() +
             #                  '\t' + res[ans_idx:].strip() + '\n')
 
 
 if __name__ == '__main__':
 
+    parser = argparse.ArgumentParser(description='Reprompt the LLM on the edges to be rewired.')
+    parser.add_argument('--resume', action='store_true', help='skip the edges already answered in the save file')
+    parser.add_argument('--shard', help='i/N: answer only the i-th of N shards of the edges (1 <= i <= N)')
+    parser.add_argument('--merge', type=int, metavar='N', help='merge the save files of N shards, without running the LLM')
+    args = parser.parse_args()
+
     config = ConfigParser()
     config.read('config.ini')
 
+    if args.merge:
+        pairs = [(parent, child) for child, parent in utils.load_reprompt_edges(config)]
+        utils.merge_shards(os.path.join('./results/', config.get('Recheck', 'save_file')), args.merge, pairs)
+        raise SystemExit
+
     print('     Current Prompt:', config.get('Paths', 'prompt_template').split('/')[-1])
     print('     Current model:', config.get('Models', 'model_id').split('/')[-1])
     print('     Current taxonomy:', config.get('Recheck', 'reprompt_file').split('/')[-1])
     print('     Current save file:', config.get('Recheck', 'save_file'))
+    if args.shard:
+        print('     Current shard:', args.shard)
 
-    semantic_predict_by_llm(config)
+    semantic_predict_by_llm(config, resume=args.resume, shard=utils.parse_shard(args.shard))
@@ -1,13 +1,21 @@
 import os
 import re
+import json
+import time
+import sqlite3
+import hashlib
+import string
+import multiprocessing as mp
 import transformers
 from transformers import BitsAndBytesConfig, AutoConfig, AutoTokenizer, AutoModelForCausalLM
 from transformers import StoppingCriteria, StoppingCriteriaList, MaxTimeCriteria
+from transformers import DynamicCache
 # from langchain_community.llms.huggingface_pipeline import HuggingFacePipeline
 import torch
 from huggingface_hub import login
 # from dotenv import load_dotenv
 import pandas as pd
+from data_mining_scripts.Taxonomy import Taxonomy
 # import Levenshtein
 # load_dotenv(override = True)
 # access_token_read = os.getenv('access_token_read_hf')
@@ -28,6 +36,7 @@ def load_llm(model_id):
     model_config = AutoConfig.from_pretrained(model_id)
     tokenizer = AutoTokenizer.from_pretrained(model_id, use_fast=True)
     tokenizer.pad_token = tokenizer.eos_token # Most LLMs don't have a pad token by default
+    tokenizer.padding_side = 'left' # decoder-only models must be padded on the left for batched generation
     model = AutoModelForCausalLM.from_pretrained(model_id,
                                                  trust_remote_code=True,
                                                  config=model_config,
@@ -86,7 +95,7 @@ def load_taxonomy(config):
             if len(triple) > 3:
                 child, parent = triple[0], triple[2]
                 rels.append(tuple([child, parent]))
-    return rels
+    return Taxonomy(rels) # taxonomy.edges() gives (parent, child) in file order
 
 
 def load_reprompt_edges(config):
@@ -115,6 +124,204 @@ def load_prompt_template(path):
     return content
 
 
+# resumable and sharded prediction runs
+def parse_shard(shard):
+    # '2/4' -> (2, 4): the second of four shards, numbered from 1
+    if shard is None:
+        return None
+    index, count = (int(x) for x in shard.split('/'))
+    if not 1 <= index <= count:
+        raise ValueError(f"Invalid shard {shard}: expected i/N with 1 <= i <= N")
+    return index, count
+
+
+def select_shard(edges, shard):
+    # every N-th edge, so that the shards get a similar mix of prompts
+    if shard is None:
+        return list(edges)
+    index, count = shard
+    return [edge for k, edge in enumerate(edges) if k % count == index - 1]
+
+
+def shard_path(path, shard):
+    # rel_results.jsonl -> rel_results.shard2of4.jsonl
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{shard[0]}of{shard[1]}{ext}"
+
+
+def load_answered_pairs(path):
+    # the cls_pairs (parent, child) already answered in a result file; a truncated last line does not count
+    answered = set()
+    if not os.path.exists(path):
+        return answered
+    with open(path, 'r') as f:
+        for line in f:
+            try:
+                answered.add(tuple(json.loads(line)['cls_pairs']))
+            except (ValueError, KeyError):
+                continue
+    return answered
+
+
+class ResultWriter:
+    """ Writes result records as JSON lines, and forces them to disk every sync_every records,
+        so that a crashed run loses at most the last few answers. In append mode,
+        a last line that was cut by a crash is removed first. """
+
+    def __init__(self, path, append=False, sync_every=100):
+        self.path = path
+        self.append = append and os.path.exists(path)
+        self.sync_every = sync_every
+        self.unsynced = 0
+        self.file = None
+
+    def __enter__(self):
+        if self.append:
+            with open(self.path, 'rb+') as f:
+                content = f.read()
+                if content and not content.endswith(b'\n'):
+                    f.truncate(content.rfind(b'\n') + 1)
+        self.file = open(self.path, 'a' if self.append else 'w')
+        return self
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def __exit__(self, *args):
+        self.sync()
+        self.file.close()
+
+
+def merge_shards(path, count, pairs):
+    # merge the results of the shards 1/count ... count/count of path into path, in the order of the (parent, child) pairs
+    records = {}
+    for index in range(1, count + 1):
+        shard_file = shard_path(path, (index, count))
+        if not os.path.exists(shard_file):
+            print("Missing shard file:", shard_file)
+            continue
+        with open(shard_file, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                records[tuple(record['cls_pairs'])] = record
+    missing = 0
+    with open(path, 'w') as writer:
+        for pair in pairs:
+            if pair in records:
+                writer.write(json.dumps(records[pair]) + '\n')
+            else:
+                missing += 1
+    print(f"Merged {len(pairs) - missing} results of {count} shards into {path}, {missing} pairs not answered yet")
+    return missing
+
+
+# persistent cache of LLM responses
+class PromptCache:
+    """ SQLite cache of LLM responses, keyed by a hash of (model id, prompt template, rendered prompt, generation settings).
+        The least recently used responses are evicted beyond max_entries (None for no bound).
+        Writes are committed every commit_every changes, and the database uses WAL mode, so that shards can share it. """
+
+    def __init__(self, path, model_id, max_entries=None, commit_every=100):
+        self.model_id = model_id
+        self.max_entries = max_entries
+        self.commit_every = commit_every
+        self.changes = 0
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, last_used REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_by_use ON responses (last_used)")
+
+    def key(self, template, prompt, settings):
+        # settings: the JSON-serializable generation settings that change the response
+        content = json.dumps([self.model_id, template, prompt, settings], sort_keys=True)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        row = self.connection.execute("SELECT response FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+        self.changed()
+        return row[0]
+
+    def put(self, key, response):
+        self.connection.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?)", (key, response, time.time()))
+        self.changed()
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if self.max_entries is not None:
+            count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            if count > self.max_entries:
+                self.connection.execute("DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                                        (count - self.max_entries,))
+        self.connection.commit()
+        self.changes = 0
+
+    def report(self):
+        lookups = self.hits + self.misses
+        entries = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        print(f"Prompt cache: {self.hits} hits, {self.misses} misses ({self.hits/max(lookups, 1):.1%} hit rate), {entries} entries")
+
+    def close(self):
+        self.commit()
+        self.report()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_prompt_cache(config):
+    # the cache of the [Cache] section of the config, or None if it is disabled
+    if not config.getboolean('Cache', 'enabled', fallback=False):
+        return None
+    max_entries = config.getint('Cache', 'max_entries', fallback=0) or None
+    return PromptCache(config.get('Cache', 'path'), config.get('Models', 'model_id'), max_entries=max_entries)
+
+
+def cache_settings(settings, prefix_cache=None):
+    # the settings of the cache keys: the answers generated with a PrefixCache are kept apart,
+    # as its batch layout may change the numerics (and so the answers) slightly
+    return settings if prefix_cache is None else dict(settings, prefix_cache=True)
+
+
+def cached(cache, template, prompt, settings, generate):
+    # the response to the prompt from the cache, or from generate() (and then stored)
+    if cache is None:
+        return generate()
+    key = cache.key(template, prompt, settings)
+    response = cache.get(key)
+    if response is None:
+        response = generate()
+        cache.put(key, response)
+    return response
+
+
 # def read_prompts(txt_path):
 #     with open(txt_path, 'r') as f:
 #         content = f.read()
@@ -135,23 +342,39 @@ def load_prompt_template(path):
 
 # New Stopping cirteria
 class StopOnTokens(StoppingCriteria):
+    """ Stops each sequence of a batch once it has ended with one of the stop token sequences more than <encounters> times.
+        The counts are kept per sequence of the batch being generated: reset() must be called before each generate(),
+        so that one instance (with its stop token ids) serves a whole run.
+        generate() pads the sequences that are done, and ends as soon as all sequences of the batch are done. """
 
     def __init__(self, stops=[], encounters=1):
         super().__init__()
         self.encounters = encounters
-        self.stop_token_ids = stops
-        self.stop_count = 0
-
-    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> bool:
-        for stop_ids in self.stop_token_ids:
-            # print(f"Testing {input_ids[0][-len(stop_ids[0])+1:]} against {stop_ids[0][1:]}")
-            if torch.eq(input_ids[0][-len(stop_ids[0])+1:], stop_ids[0][1:]).all():
-                self.stop_count += 1
-                break              
-        # print(self.stop_count, self.encounters)
-        if self.stop_count > self.encounters:
-            return True
-        return False
+        # the first token of a stop sequence depends on the text before it, so we match the other tokens
+        self.stop_token_ids = [stop_ids[0][1:] if stop_ids.shape[-1] > 1 else stop_ids[0] for stop_ids in stops]
+        self.stop_count = None
+
+    def reset(self):
+        self.stop_count = None
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        if self.stop_count is None:
+            self.stop_count = torch.zeros(input_ids.shape[0], dtype=torch.long, device=input_ids.device)
+        matched = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        for k, stop_ids in enumerate(self.stop_token_ids):
+            if stop_ids.device != input_ids.device:
+                stop_ids = self.stop_token_ids[k] = stop_ids.to(input_ids.device)
+            if input_ids.shape[1] >= len(stop_ids):
+                matched |= torch.eq(input_ids[:, -len(stop_ids):], stop_ids).all(dim=1)
+        self.stop_count += matched
+        return self.stop_count > self.encounters
+
+
+def reset_stopping_criteria(stopping_criteria):
+    # to call before each generate() with the stopping criteria
+    for criteria in stopping_criteria or []:
+        if isinstance(criteria, StopOnTokens):
+            criteria.reset()
 
 def get_stop_tokens(stop_list, tokenizer):
     # stop_list = ["<human>:", "<bot>:"]
@@ -162,12 +385,187 @@ def get_stop_tokens(stop_list, tokenizer):
 
 
 def set_stopping_criteria(tokenizer):
+    # build once per run, and call reset_stopping_criteria before every generation
     stop_list = ['\nExplanation:', '\nAnswer:', 'Answer:', 'Explanation:']
     stop_words_ids = get_stop_tokens(stop_list, tokenizer)
     stopping_criteria = StoppingCriteriaList([StopOnTokens(stops=stop_words_ids, encounters=2)])
     return stopping_criteria
 
 
+# reuse of the KV cache of the fixed beginning of the prompts
+class PrefixCache:
+    """ KV cache of the chat input up to the first slot of a prompt template, computed once.
+        generate() takes the chat inputs of prompts of that template, and lays out each batch as
+        [prefix tokens | padding | rest of the prompt], so that the prefix is at the same positions in all rows
+        (the padding is masked, and the positions follow the attention mask). Only the rest of the prompts is
+        then prefilled. Prompts whose tokens do not start with the prefix go through the pipeline. """
+
+    def __init__(self, llm, template, add_generation_prompt=False):
+        self.llm = llm
+        model, tokenizer = llm.model, llm.tokenizer
+        fixed = ''
+        for literal, field, _, _ in string.Formatter().parse(template):
+            fixed += literal
+            if field is not None:
+                break
+        messages = [{"role": "user", "content": template}]
+        chat = tokenizer.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+        # the last token of the prefix may merge with the text of the first slot, so we leave it out
+        # tokenized as the text-generation pipeline does, with the special tokens of the tokenizer
+        prefix_ids = tokenizer(chat[:chat.index(fixed) + len(fixed)])['input_ids'][:-1]
+        self.prefix_ids = torch.tensor([prefix_ids], dtype=torch.long, device=model.device)
+        with torch.no_grad():
+            past = model(input_ids=self.prefix_ids, use_cache=True).past_key_values
+        self.past = past.to_legacy_cache() if hasattr(past, 'to_legacy_cache') else past
+
+    def split(self, inputs):
+        # the tokens after the prefix of each input, or None if the input does not start with the prefix
+        prefix = self.prefix_ids[0].tolist()
+        rests = []
+        for ids in self.llm.tokenizer(inputs)['input_ids']:
+            rests.append(ids[len(prefix):] if ids[:len(prefix)] == prefix and len(ids) > len(prefix) else None)
+        return rests
+
+    def cache_for(self, batch_size):
+        # a fresh copy for each batch, since generate() extends the cache it is given
+        return DynamicCache.from_legacy_cache(tuple((k.expand(batch_size, -1, -1, -1).contiguous(),
+                                                     v.expand(batch_size, -1, -1, -1).contiguous()) for k, v in self.past))
+
+    def layout(self, rests):
+        # input_ids and attention_mask of [prefix | padding | rest] for a batch
+        width = max(len(rest) for rest in rests)
+        pad = self.llm.tokenizer.pad_token_id
+        ids = torch.tensor([[pad] * (width - len(rest)) + rest for rest in rests], dtype=torch.long)
+        mask = torch.tensor([[0] * (width - len(rest)) + [1] * len(rest) for rest in rests], dtype=torch.long)
+        ids, mask = ids.to(self.prefix_ids.device), mask.to(self.prefix_ids.device)
+        prefix = self.prefix_ids.expand(len(rests), -1)
+        return torch.cat([prefix, ids], dim=1), torch.cat([torch.ones_like(prefix), mask], dim=1)
+
+    def generate(self, inputs, **generation_kwargs):
+        # the generated texts of the chat inputs, as the pipeline with return_full_text=False would return them
+        generation_kwargs = {key: value for key, value in generation_kwargs.items() if key not in ('return_full_text', 'batch_size')}
+        rests = self.split(inputs)
+        texts = [None] * len(inputs)
+        cached = [i for i, rest in enumerate(rests) if rest is not None]
+        if cached:
+            input_ids, attention_mask = self.layout([rests[i] for i in cached])
+            reset_stopping_criteria(generation_kwargs.get('stopping_criteria'))
+            with torch.no_grad():
+                sequences = self.llm.model.generate(input_ids=input_ids, attention_mask=attention_mask,
+                                                    past_key_values=self.cache_for(len(cached)),
+                                                    pad_token_id=self.llm.tokenizer.pad_token_id, **generation_kwargs)
+            generated = self.llm.tokenizer.batch_decode(sequences[:, input_ids.shape[1]:], skip_special_tokens=True)
+            for i, text in zip(cached, generated):
+                texts[i] = text
+        for i, rest in enumerate(rests):
+            if rest is None:
+                reset_stopping_criteria(generation_kwargs.get('stopping_criteria'))
+                texts[i] = self.llm(inputs[i], return_full_text=False, **generation_kwargs)[0]["generated_text"]
+        return texts
+
+
+def benchmark_prefix_cache(model_id, template_path, slots, repeats=3):
+    '''
+    Compare the prefill time of a batch of prompts with and without the PrefixCache of their template, on the CPU.
+    Use a small local model with a chat template, e.g. benchmark_prefix_cache('HuggingFaceTB/SmolLM2-135M-Instruct',
+    './prompts/semantic_prediction.txt', [dict(parent_label='city', parent_desc='large human settlement',
+    child_label='capital', child_desc='seat of government')] * 8)
+    @param slots: one dict of slot values per prompt of the batch
+    '''
+    tokenizer = AutoTokenizer.from_pretrained(model_id)
+    tokenizer.pad_token = tokenizer.pad_token or tokenizer.eos_token
+    tokenizer.padding_side = 'left'
+    model = AutoModelForCausalLM.from_pretrained(model_id, torch_dtype=torch.float32).eval()
+    llm = transformers.pipeline(task='text-generation', model=model, tokenizer=tokenizer, device='cpu')
+    template = load_prompt_template(template_path)
+    inputs = [tokenizer.apply_chat_template([{"role": "user", "content": template.format(**values)}],
+                                            tokenize=False, add_generation_prompt=False) for values in slots]
+
+    start = time.time()
+    prefix_cache = PrefixCache(llm, template)
+    setup = time.time() - start
+    full = tokenizer(inputs, return_tensors='pt', padding=True)
+    input_ids, attention_mask = prefix_cache.layout(prefix_cache.split(inputs))
+    timings = {'full prefill': [], 'prefill with prefix cache': []}
+    with torch.no_grad():
+        for _ in range(repeats):
+            start = time.time()
+            model(**full)
+            timings['full prefill'].append(time.time() - start)
+            start = time.time()
+            past = prefix_cache.cache_for(len(inputs))
+            model(input_ids=input_ids[:, past.get_seq_length():], attention_mask=attention_mask,
+                  position_ids=(attention_mask.cumsum(-1) - 1).clamp(min=0)[:, past.get_seq_length():], past_key_values=past)
+            timings['prefill with prefix cache'].append(time.time() - start)
+    print(f"{len(inputs)} prompts of {full['input_ids'].shape[1]} tokens, prefix of {prefix_cache.prefix_ids.shape[1]} tokens "
+          f"(computed once in {setup:.3f}s)")
+    for name, values in timings.items():
+        print(f"  {name}: {min(values):.3f}s")
+    print(f"  speedup: {min(timings['full prefill']) / min(timings['prefill with prefix cache']):.1f}x")
+    return timings
+
+
+# scoring of the candidate answers, instead of generation
+# label (as parse_output returns it) -> answer, in the format that the prompt asks for
+ANSWER_CANDIDATES = {
+    '[SUBCLS]': 'ConceptA is superclass of ConceptB.',
+    '[INVERSE]': 'ConceptA is subclass of ConceptB.',
+    '[EQUIV]': 'ConceptA is equivalent to ConceptB.',
+    '[IRREL]': 'ConceptA is irrelevant to ConceptB.',
+    '[NONE]': 'None.',
+}
+ANSWER_PREFIX = 'Answer:'
+
+
+def score_candidates(llm, prefixes, candidates):
+    '''
+    Mean log-likelihood per token of each candidate continuation of each prefix, as a (len(prefixes), len(candidates)) tensor.
+    A candidate continues a prefix after a space, as a generated answer would (' ConceptA', not 'ConceptA' for BPE tokenizers):
+    its tokens are those of prefix + ' ' + candidate after the tokens of the prefix. They are taken from the first prefix,
+    as the prefixes end the same way (e.g. with ANSWER_PREFIX). The mean, not the sum, keeps short candidates
+    such as 'None.' from being favoured for their length.
+    One forward pass over the (left-padded) prefixes computes their KV cache, which is repeated for all candidates,
+    and one forward pass over all (prefix, candidate) pairs scores the candidate tokens.
+    '''
+    model, tokenizer = llm.model, llm.tokenizer
+    device = model.device
+    # the chat template already contains the special tokens
+    prefix = tokenizer(prefixes, return_tensors='pt', padding=True, add_special_tokens=False).to(device)
+    prefix_ids = tokenizer(prefixes[0], add_special_tokens=False)['input_ids']
+    candidate_ids = []
+    for candidate in candidates:
+        ids = tokenizer(prefixes[0] + ' ' + candidate, add_special_tokens=False)['input_ids']
+        if ids[:len(prefix_ids)] != prefix_ids:
+            raise ValueError(f'The candidate {candidate!r} merges with the last token of the prefix')
+        candidate_ids.append(ids[len(prefix_ids):])
+    count, length = len(candidates), max(len(ids) for ids in candidate_ids)
+    ids = torch.full((count, length), tokenizer.pad_token_id, dtype=torch.long)
+    mask = torch.zeros((count, length), dtype=torch.long)
+    for k, candidate in enumerate(candidate_ids):
+        ids[k, :len(candidate)] = torch.tensor(candidate)
+        mask[k, :len(candidate)] = 1
+    # row b*count+k is candidate k after prefix b
+    ids, mask = ids.repeat(len(prefixes), 1).to(device), mask.repeat(len(prefixes), 1).to(device)
+
+    with torch.no_grad():
+        prefix_mask = prefix['attention_mask']
+        outputs = model(input_ids=prefix['input_ids'], attention_mask=prefix_mask,
+                        position_ids=(prefix_mask.cumsum(-1) - 1).clamp(min=0), use_cache=True)
+        first = torch.log_softmax(outputs.logits[:, -1].float(), dim=-1).repeat_interleave(count, 0)
+        past = outputs.past_key_values
+        if hasattr(past, 'to_legacy_cache'):
+            past = past.to_legacy_cache()
+        past = DynamicCache.from_legacy_cache(tuple((k.repeat_interleave(count, 0), v.repeat_interleave(count, 0)) for k, v in past))
+        positions = prefix_mask.sum(-1).repeat_interleave(count, 0)[:, None] + torch.arange(length, device=device)[None]
+        logits = model(input_ids=ids, attention_mask=torch.cat([prefix_mask.repeat_interleave(count, 0), mask], dim=1),
+                       position_ids=positions, past_key_values=past).logits
+        # the first candidate token is predicted by the prefix, token j+1 by candidate token j
+        scores = first.gather(-1, ids[:, :1])[:, 0]
+        rest = torch.log_softmax(logits[:, :-1].float(), dim=-1).gather(-1, ids[:, 1:, None])[..., 0]
+        scores = (scores + (rest * mask[:, 1:]).sum(-1)) / mask.sum(-1)
+    return scores.view(len(prefixes), count).cpu()
+
+
 # post-processing the generated text
 CORRECT_PARADIM = [
     "it would be most accurate to state",
@@ -332,4 +730,129 @@ def parse_output(answer):
     
     # If none of the above situations satisfy, then the answer is 'none'.
     answer = '[NONE]'
-    return answer
\ No newline at end of file
+    return answer
+
+
+# compiled version of parse_output, for whole result files
+NEGATION_WORDS = r"not|no|neither|nor|irrelevant|irrelevent|irrevelant|unrelated"
+RELATION_FAMILIES = {
+    'subclass': ['subclass'],
+    'superclass': ['superclass'],
+    'irrelevant': ['irrelevant', 'irrelevent', 'irrelevance', 'irrevelant'],
+    'equivalent': ['equivalent', 'equivlant', 'equivant', 'synonym'],
+}
+
+
+class AnswerParser:
+    """ Gives the same labels as parse_output, with all patterns compiled once:
+        - the paradigm phrases are looked up by one alternation each (the list order is checked only if one occurs),
+        - the relation words of all families are found by one alternation, and the answer is split
+          into segments once instead of once per identify_negations call,
+        - the negation pattern of a relation (compiled once) is only tried on segments
+          that contain both a negation word and the relation. """
+
+    def __init__(self):
+        self.none_phrases = re.compile('|'.join(re.escape(phrase) for phrase in NONE_PARADIM))
+        self.correct_phrases = re.compile('|'.join(re.escape(phrase) for phrase in CORRECT_PARADIM))
+        self.conjunctions = re.compile(r'\b(and|but|however)\b', re.IGNORECASE)
+        self.separators = re.compile(r'[;.]\s*')
+        self.negation_word = re.compile(rf"\b({NEGATION_WORDS})\b", re.IGNORECASE)
+        self.segment_negation = re.compile(r'\b(not|isn\'t|aren\'t)\b')
+        relations = [relation for family in RELATION_FAMILIES.values() for relation in family]
+        self.relation_word = re.compile(rf"\b({'|'.join(relations)})\b", re.IGNORECASE)
+        # the pattern of identify_negations
+        self.negated_relation = {relation: re.compile(rf"\b({NEGATION_WORDS})\b\s*(.*?)?(a\s)?\b({relation})\b", re.IGNORECASE)
+                                 for relation in relations}
+
+    def negations(self, text):
+        # identify_negations(text, family) for all relations at once: a relation is negated (True) if a segment
+        # negates it, asserted (False) if it occurs in the text and a segment has no negation, and None otherwise
+        text = self.conjunctions.sub(';', text)
+        segments = self.separators.split(text)
+        present = set(match.lower() for match in self.relation_word.findall(text))
+        asserted = any(not self.segment_negation.search(segment) for segment in segments)
+        negated = {relation: (False if relation in present and asserted else None)
+                   for family in RELATION_FAMILIES.values() for relation in family}
+        for segment in segments:
+            if not self.negation_word.search(segment):
+                continue
+            for relation in set(match.lower() for match in self.relation_word.findall(segment)):
+                if self.negated_relation[relation].search(segment):
+                    negated[relation] = True
+        return negated
+
+    def parse(self, answer):
+        answer = answer.lower()
+        if self.none_phrases.search(answer):
+            return '[NONE]'
+        if self.correct_phrases.search(answer):
+            for cparam in CORRECT_PARADIM:
+                if cparam in answer:
+                    answer = answer[answer.find(cparam):].strip().split('. ')[0]
+                    break
+
+        negated = self.negations(answer)
+        neg_sub = negated['subclass']
+        neg_sup = negated['superclass']
+        families = {}
+        for family in ('irrelevant', 'equivalent'):
+            values = set(negated[relation] for relation in RELATION_FAMILIES[family])
+            families[family] = False if False in values else (True if True in values else None)
+        neg_irrel, neg_eq = families['irrelevant'], families['equivalent']
+
+        # the decisions of parse_output
+        if neg_eq and neg_sub and neg_sup:
+            return '[NONE]'
+        if neg_irrel is False:
+            return '[IRREL]'
+        if neg_sub is False or neg_sup is False:
+            if neg_sub is False and neg_sup is False:
+                return '[SUBCLS]'
+            segments = self.separators.split(answer)
+            if neg_sub is False:
+                return identify_hierarchy_order(next((seg for seg in segments if 'subclass' in seg), None))
+            sup_seg = next((seg for seg in segments if 'superclass' in seg), None)
+            if 'concepta' not in sup_seg and 'conceptb' not in sup_seg and 'share' in sup_seg:
+                return '[NONE]'
+            return identify_hierarchy_order(sup_seg)
+        if neg_eq is False:
+            return '[EQUIV]'
+        return '[NONE]'
+
+    def parse_many(self, answers, processes=None, chunksize=1000):
+        # the labels of many answers, in order, over a pool of processes if processes > 1
+        if processes is None or processes <= 1:
+            return [self.parse(answer) for answer in answers]
+        with mp.Pool(processes) as pool:
+            return pool.map(parse_answer, answers, chunksize=chunksize)
+
+
+ANSWER_PARSER = AnswerParser()
+
+
+def parse_answer(answer):
+    # parse_output with the compiled parser
+    return ANSWER_PARSER.parse(answer)
+
+
+def verify_answer_parser(result_files):
+    # check the compiled parser against parse_output on the answers of result files (JSON lines with an 'answer')
+    checked = mismatches = 0
+    for path in result_files:
+        with open(path, 'r') as f:
+            for line in f:
+                answer = json.loads(line)['answer']
+                try:
+                    expected = parse_output(answer)
+                except ValueError as e:
+                    expected = e.__class__
+                try:
+                    actual = ANSWER_PARSER.parse(answer)
+                except ValueError as e:
+                    actual = e.__class__
+                checked += 1
+                if actual != expected:
+                    mismatches += 1
+                    print(f"Mismatch: {expected} vs {actual} for {answer!r}")
+    print(f"Compiled parser checked on {checked} answers: {mismatches} mismatches")
+    return mismatches == 0